@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from globals import message_worker
+
+
+class AsyncWorker:
+    """One long-lived event loop thread, fed through a bounded queue by the Flask request threads.
+
+    Tasks submitted with a key form that key's mailbox: they run one at a time in
+    submission order, while tasks for different keys run concurrently.
+    """
+
+    def __init__(
+        self,
+        max_queue_size=message_worker["max_queue_size"],
+        concurrency=message_worker["concurrency"],
+        queue_full_policy=message_worker["queue_full_policy"],
+        queue_full_wait=message_worker["queue_full_wait_seconds"],
+    ):
+        self.max_queue_size = max_queue_size
+        self.concurrency = concurrency
+        self.queue_full_policy = queue_full_policy  # "reject" or "wait"
+        self.queue_full_wait = queue_full_wait
+
+        # admission is tracked here rather than on the asyncio.Queue so request threads never touch the loop
+        self.admission = threading.Condition()
+        self.queued = 0
+        self.active = 0
+        self.max_queued = 0
+        self.accepted_tasks = 0
+        self.rejected_tasks = 0
+        self.wait_times = deque(maxlen=message_worker["wait_time_window"])
+
+        self.loop = asyncio.new_event_loop()
+        # blocking handlers run via asyncio.to_thread, keep that pool as small as the worker count
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+        self.queue = None
+        self.mailboxes = (
+            {}
+        )  # key -> deque of tasks waiting behind the one running, loop thread only
+        self.ready = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run_loop, name="async-worker", daemon=True
+        )
+        self.thread.start()
+        self.ready.wait()
+
+    def run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.queue = asyncio.Queue()
+        for i in range(self.concurrency):
+            self.loop.create_task(self.work())
+        self.loop.call_soon(self.ready.set)
+        self.loop.run_forever()
+
+    def submit(self, coroutine_function, *args, key=None):
+        """Schedule coroutine_function(*args) on the loop, False if the queue is full."""
+        with self.admission:
+            if self.queued >= self.max_queue_size and self.queue_full_policy == "wait":
+                self.admission.wait_for(
+                    lambda: self.queued < self.max_queue_size,
+                    timeout=self.queue_full_wait,
+                )
+            if self.queued >= self.max_queue_size:
+                self.rejected_tasks += 1
+                return False
+            self.queued += 1
+            self.accepted_tasks += 1
+            self.max_queued = max(self.max_queued, self.queued)
+
+        self.loop.call_soon_threadsafe(
+            self.queue.put_nowait, (time.monotonic(), key, coroutine_function, args)
+        )
+        return True
+
+    def run_coroutine(self, coroutine):
+        """Run a coroutine on the worker loop outside the queue, returning a concurrent Future."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def work(self):
+        while True:
+            task = await self.queue.get()
+            key = task[1]
+            if key is None:
+                await self.run_task(task)
+                continue
+            if key in self.mailboxes:
+                # this key's mailbox is already being worked through, wait in line
+                self.mailboxes[key].append(task)
+                continue
+            mailbox = self.mailboxes[key] = deque()
+            try:
+                await self.run_task(task)
+                while mailbox:
+                    await self.run_task(mailbox.popleft())
+            finally:
+                del self.mailboxes[key]
+
+    async def run_task(self, task):
+        enqueued_at, key, coroutine_function, args = task
+        with self.admission:
+            self.queued -= 1
+            self.active += 1
+            self.wait_times.append(time.monotonic() - enqueued_at)
+            self.admission.notify()
+        try:
+            await coroutine_function(*args)
+        except Exception as e:
+            logging.error(f"Unhandled error in async worker task: {e}", exc_info=True)
+        finally:
+            with self.admission:
+                self.active -= 1
+
+    def stats(self):
+        with self.admission:
+            wait_times = sorted(self.wait_times)
+            return {
+                "queue_depth": self.queued,
+                "max_queue_depth": self.max_queued,
+                "active_tasks": self.active,
+                "busy_mailboxes": len(self.mailboxes),
+                "accepted_tasks": self.accepted_tasks,
+                "rejected_tasks": self.rejected_tasks,
+                "wait_p50_ms": percentile(wait_times, 50) * 1000,
+                "wait_p95_ms": percentile(wait_times, 95) * 1000,
+                "wait_max_ms": (wait_times[-1] if wait_times else 0.0) * 1000,
+            }
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, round(pct / 100 * (len(sorted_values) - 1)))
+    return sorted_values[index]
@@ -1,9 +1,9 @@
 import json
 from datetime import datetime
 
-import requests
-
 from globals import bactrack_stats
+from http_client import shared_http_client
+from log_setup import truncate
 import logging
 
 
@@ -20,9 +20,11 @@ class BacTrackStats:
         self, current_day_of_week=datetime.now().isoweekday()
     ):
         logging.info("Making call to BacTrack Stats API")
-        result = requests.get(url=self.url + str(current_day_of_week))
+        result = shared_http_client.get(
+            "bactrack_stats", url=self.url + str(current_day_of_week)
+        )
         logging.info(
-            f"Received response from BacTrack Stats API with Status: {result.status_code}, Payload: {result.text}"
+            f"Received response from BacTrack Stats API with Status: {result.status_code}, Payload: {truncate(result.text)}"
         )
         histogram_dict = {}
         try:
@@ -0,0 +1,119 @@
+import struct
+from enum import IntEnum
+
+# 13-byte test notification: 2 bytes we don't use, stage, reading (big-endian, ten-thousandths
+# of BAC), countdown, 7 more bytes we don't use. Stage and countdown live in the low nibbles.
+frame_layout = struct.Struct(">2xBHB7x")
+frame_length = frame_layout.size
+stage_offset = 2
+countdown_offset = 5
+reading_layout = struct.Struct(">H")
+reading_offset = 3
+
+
+class Stage(IntEnum):
+    WARMING_UP = 1
+    BEGIN_BLOWING = 2
+    KEEP_BLOWING = 3
+    PROCESSING = 4
+    ATTAINED_RESULTS = 5
+
+
+# enum attribute lookups cost more than the rest of a decode, hot paths compare against this
+results_stage = Stage.ATTAINED_RESULTS
+
+
+class Frame:
+    """One decoded notification. Slotted, so there is no per-instance dict, and read-only."""
+
+    __slots__ = ("stage", "countdown", "description", "raw_reading")
+
+    def __init__(self, stage, countdown, description, raw_reading=0):
+        # __setattr__ refuses every write, the slot descriptors below are the only way in
+        set_stage(self, stage)
+        set_countdown(self, countdown)
+        set_description(self, description)  # what Logic.message_callback is told
+        # ten-thousandths of BAC, only set for ATTAINED_RESULTS
+        set_raw_reading(self, raw_reading)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"Frame is immutable, cannot set {name}")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"Frame is immutable, cannot delete {name}")
+
+    def __eq__(self, other):
+        if not isinstance(other, Frame):
+            return NotImplemented
+        return self.fields() == other.fields()
+
+    def __hash__(self):
+        return hash(self.fields())
+
+    def __repr__(self):
+        return (
+            f"Frame(stage={self.stage.name}, countdown={self.countdown}, "
+            f"description={self.description!r}, raw_reading={self.raw_reading})"
+        )
+
+    def fields(self):
+        return self.stage, self.countdown, self.description, self.raw_reading
+
+    @property
+    def milli_bac(self):
+        return (self.raw_reading + 5) // 10
+
+    @property
+    def reading(self):
+        """BAC as the three-decimal string the rest of the app uses, e.g. "0.045".
+
+        Rounded once, half up, in integer milli-BAC; the float below is then exact to
+        three places, so formatting it cannot round a second time.
+        """
+        return f"{self.milli_bac / 1000:.3f}"
+
+
+set_stage = Frame.stage.__set__
+set_countdown = Frame.countdown.__set__
+set_description = Frame.description.__set__
+set_raw_reading = Frame.raw_reading.__set__
+
+
+def describe(stage, countdown):
+    if stage is Stage.KEEP_BLOWING and countdown == 0:
+        return "STOP_BLOWING"
+    return stage.name
+
+
+# every frame short of the result is fully determined by the stage and countdown nibbles, so
+# they are built once up front and shared. Result frames carry a reading and unknown stages
+# are rejected, both stay None here and fall through to the slow path.
+frame_table = [None] * 256
+for stage in Stage:
+    if stage is not results_stage:
+        for countdown in range(16):
+            frame_table[stage << 4 | countdown] = Frame(
+                stage, countdown, describe(stage, countdown)
+            )
+
+
+def decode_frame(data):
+    """Frame for a notification payload, or None when it is the wrong length or an unknown stage.
+
+    data is any buffer: the bytearray Bleak hands us, bytes, or a memoryview over either.
+    The two nibbles are read by index, which is cheaper than any struct call; the result
+    frame, once per test, unpacks its reading through a memoryview, so nothing is copied.
+    """
+    if len(data) != frame_length:
+        return None
+    frame = frame_table[
+        (data[stage_offset] & 0x0F) << 4 | data[countdown_offset] & 0x0F
+    ]
+    if frame is not None:
+        return frame
+    if data[stage_offset] & 0x0F != results_stage:
+        return None
+    (raw_reading,) = reading_layout.unpack_from(memoryview(data), reading_offset)
+    return Frame(
+        results_stage, data[countdown_offset] & 0x0F, results_stage.name, raw_reading
+    )
@@ -0,0 +1,709 @@
+import argparse
+import asyncio
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from sortedcontainers import SortedDict
+from twilio.rest import Client
+
+from bactrack_frames import decode_frame
+from ble_simulator import SimulatedBreathalyzer, client_factory
+from breathalyzer_client import BacTrack, BreathalyzerPool
+from http_client import HttpClient
+from async_worker import percentile
+from leaderboard import Leaderboard
+from log_setup import DroppingQueueHandler, truncate
+from messaging import OutboundMessenger, OutboundQueue
+from metrics import Counter, Histogram, MetricsRegistry
+from scheduler import TestScheduler
+from sqlite_store import SqliteStateStore
+from stage_timing import StageTimings
+from user import User, GameStateJournal, PersistenceWriter, persist_users_data
+from vestaboard_client import (
+    AbsolutePosition,
+    Message,
+    SubMessage,
+    SubMessageStyle,
+    VbmlCache,
+    convert_vbml_to_array,
+)
+
+
+def make_users(user_count):
+    users = {"leaders": Leaderboard()}
+    for i in range(user_count):
+        number = f"+1555{i:07d}"
+        users[number] = User(
+            number=number,
+            username=f"u{i}",
+            next_step="gameplay",
+            agree_to_terms=True,
+            onboarded=True,
+        )
+        users["leaders"].upsert(f"u{i}", f"{(i % 300) / 1000:.3f}", datetime.now())
+    return users
+
+
+def bench_journal(sizes=(10, 100, 1000, 10000), mutations=200):
+    """Per-mutation write cost of the journal vs. the old full snapshot rewrite."""
+    print(f"{'users':>8} {'journal us/op':>15} {'snapshot us/op':>16}")
+    for size in sizes:
+        users = make_users(size)
+        number = next(key for key in users if key != "leaders")
+        with tempfile.TemporaryDirectory() as backup_dir:
+            # never compact inside the timed loop, we want the steady-state append cost
+            journal = GameStateJournal(backup_dir, compaction_threshold=mutations + 1)
+            start = time.perf_counter()
+            for i in range(mutations):
+                journal.record_test(users, number, f"{i / 1000:.3f}", time.time())
+            journal_cost = (time.perf_counter() - start) / mutations
+            journal.close()
+
+            snapshot_mutations = max(1, min(mutations, 20000 // size))
+            start = time.perf_counter()
+            for _ in range(snapshot_mutations):
+                persist_users_data(users, backup_dir)
+            snapshot_cost = (time.perf_counter() - start) / snapshot_mutations
+        print(f"{size:>8} {journal_cost * 1e6:>15.1f} {snapshot_cost * 1e6:>16.1f}")
+
+
+def bench_writer(
+    user_count=100,
+    active_guests=3,
+    tests_per_second=20,
+    seconds=3,
+    flush_interval_ms=250,
+):
+    """Coalesced vs. physical writes for a burst of onboarding and test traffic.
+
+    Only active_guests guests are at the breathalyzer at a time, so each of them changes
+    their user record and leaderboard entry several times within one flush interval.
+    """
+    users = make_users(user_count)
+    numbers = [key for key in users if key != "leaders"]
+    with tempfile.TemporaryDirectory() as backup_dir:
+        writer = PersistenceWriter(
+            GameStateJournal(backup_dir), flush_interval_ms=flush_interval_ms
+        )
+        start = time.perf_counter()
+        submit_cost = 0.0
+        for i in range(tests_per_second * seconds):
+            number = numbers[i % min(active_guests, len(numbers))]
+            submit_start = time.perf_counter()
+            writer.record_user(users, number)  # picked a username
+            writer.record_user(users, number)  # agreed to the terms
+            writer.record_test(users, number, f"{i / 1000:.3f}", time.time())
+            writer.record_leader(users, users[number].username, "0.050", datetime.now())
+            submit_cost += time.perf_counter() - submit_start
+            time.sleep(
+                max(0.0, start + (i + 1) / tests_per_second - time.perf_counter())
+            )
+        writer.close()
+        stats = writer.stats()
+    print(
+        f"caller cost per mutation: {submit_cost / stats['submitted_records'] * 1e6:.1f} us"
+    )
+    print(
+        f"submitted: {stats['submitted_records']}, coalesced: {stats['coalesced_records']} "
+        f"({stats['coalesced_records'] / stats['submitted_records']:.0%}), "
+        f"physical writes: {stats['physical_writes']}"
+    )
+
+
+def bench_restore(sizes=(10, 1000, 10000), tests_per_user=3):
+    """Restart recovery time of the JSON snapshot + journal vs. the SQLite backend."""
+    print(f"{'users':>8} {'journal ms':>11} {'sqlite ms':>10} {'sqlite us/test':>15}")
+    for size in sizes:
+        users = make_users(size)
+        for number, user in users.items():
+            if number != "leaders":
+                for i in range(tests_per_user):
+                    user.test_history.append(f"0.0{i}0", time.time())
+        with tempfile.TemporaryDirectory() as backup_dir:
+            journal = GameStateJournal(backup_dir)
+            journal.compact(users)
+            journal.close()
+            start = time.perf_counter()
+            GameStateJournal(backup_dir).restore()
+            journal_restore = time.perf_counter() - start
+
+            store = SqliteStateStore(backup_dir)
+            store.compact(users)
+            number = next(key for key in users if key != "leaders")
+            start = time.perf_counter()
+            for i in range(100):
+                store.append(
+                    users,
+                    {
+                        "op": "test",
+                        "number": number,
+                        "reading": "0.010",
+                        "timestamp": time.time(),
+                    },
+                )
+            sqlite_append = (time.perf_counter() - start) / 100
+            start = time.perf_counter()
+            store.restore()
+            sqlite_restore = time.perf_counter() - start
+            store.close()
+        print(
+            f"{size:>8} {journal_restore * 1e3:>11.1f} {sqlite_restore * 1e3:>10.1f} "
+            f"{sqlite_append * 1e6:>15.1f}"
+        )
+
+
+class DictUser:
+    """The pre-slots User layout, kept here only as a memory baseline."""
+
+    def __init__(self, number, username):
+        self.number = number
+        self.username = username
+        self.next_step = "gameplay"
+        self.agreed_to_terms = True
+        self.onboarded = True
+        self.test_history = SortedDict()
+
+
+def bench_user_memory(user_count=1000, tests_per_user=8):
+    """Bytes per guest for the old dict/SortedDict User vs. the slotted array-backed one."""
+
+    def measure(build):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        users = build()
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return (after - before) / len(users)
+
+    def build_dict_users():
+        users = []
+        for i in range(user_count):
+            user = DictUser(f"+1555{i:07d}", f"u{i}")
+            for t in range(tests_per_user):
+                user.test_history[f"0.{i % 100:02d}{t}"] = datetime.now().strftime(
+                    "%Y-%m-%d %H:%M:%S"
+                )
+            users.append(user)
+        return users
+
+    def build_slotted_users():
+        users = []
+        for i in range(user_count):
+            user = User(f"+1555{i:07d}", f"u{i}")
+            for t in range(tests_per_user):
+                user.test_history.append(f"0.{i % 100:02d}{t}", time.time())
+            users.append(user)
+        return users
+
+    print(f"{tests_per_user} tests per guest")
+    print(
+        f"dict User + SortedDict history: {measure(build_dict_users):.0f} bytes/guest"
+    )
+    print(
+        f"slotted User + array history:   {measure(build_slotted_users):.0f} bytes/guest"
+    )
+
+
+def list_leaderboard_update(leaders, username, bac_value, reading_time):
+    """The old list-of-lists update: linear find, full re-sort, then two more scans."""
+    for leader in leaders:
+        if leader[0] == username:
+            leader[1] = bac_value
+            leader[2] = reading_time
+            break
+    else:
+        leaders.append([username, bac_value, reading_time])
+    leaders.sort(key=lambda x: x[1], reverse=True)
+    rank = next(i for i, leader in enumerate(leaders) if leader[0] == username)
+    return rank, leaders[:3]
+
+
+def bench_leaderboard(sizes=(10, 1000, 100000), updates=1000):
+    """Cost of one test's leaderboard update + rank + podium lookup."""
+    print(f"{'entries':>8} {'list us/op':>11} {'Leaderboard us/op':>18}")
+    for size in sizes:
+        leaders = [
+            [f"u{i}", f"{(i * 7919 % 300) / 1000:.3f}", datetime.now()]
+            for i in range(size)
+        ]
+        leaders.sort(key=lambda x: x[1], reverse=True)
+        leaderboard = Leaderboard.from_list(leaders)
+        now = datetime.now()
+        readings = [
+            (f"u{i * 104729 % size}", f"{(i * 31 % 300) / 1000:.3f}")
+            for i in range(updates)
+        ]
+
+        list_updates = min(updates, max(10, 2000000 // (size * 20)))
+        start = time.perf_counter()
+        for username, bac in readings[:list_updates]:
+            list_leaderboard_update(leaders, username, bac, now)
+        list_cost = (time.perf_counter() - start) / list_updates
+
+        start = time.perf_counter()
+        for username, bac in readings:
+            leaderboard.upsert(username, bac, now)
+            leaderboard.rank(username)
+            leaderboard.top(3)
+        leaderboard_cost = (time.perf_counter() - start) / updates
+        print(f"{size:>8} {list_cost * 1e6:>11.1f} {leaderboard_cost * 1e6:>18.1f}")
+
+
+def bench_vbml(frames=2000):
+    """Local VBML render vs. an LRU cache hit for a repeated leaderboard frame."""
+    message = Message(
+        components=[
+            SubMessage(
+                template="{64}{68}{64}{68}{64}Leaderboard{64}{68}{64}{68}{64}{68}\n"
+                "1 alex   .112 -14min\n2 sam    .085 recent\n3 jo     .041 -37min\n"
+                + "{64}{68}" * 11
+                + "\nYou take the silver!",
+                style=SubMessageStyle(
+                    height=6,
+                    width=22,
+                    justify="center",
+                    align="center",
+                    absolutePosition=AbsolutePosition(x=0, y=0),
+                ),
+            )
+        ]
+    )
+    for label, cache_size in (("render every frame", 0), ("LRU cache", 128)):
+        cache = VbmlCache(max_size=cache_size, cache_file=None)
+        start = time.perf_counter()
+        for _ in range(frames):
+            convert_vbml_to_array(message, cache=cache, renderer="local")
+        cost = (time.perf_counter() - start) / frames
+        print(f"{label:>20}: {cost * 1e6:.1f} us/frame, {cache.stats()}")
+
+
+class LocalApiHandler(BaseHTTPRequestHandler):
+    """Answers every request with a small JSON body over a keep-alive HTTP/1.1 connection."""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # headers and body go out as separate writes
+    response_body = b'{"ok": true}'
+    response_status = 200
+    response_delay = 0.0
+
+    def respond(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+        if self.response_delay:
+            time.sleep(self.response_delay)
+        self.send_response(self.response_status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(self.response_body)))
+        self.end_headers()
+        self.wfile.write(self.response_body)
+
+    do_GET = respond
+    do_POST = respond
+
+    def log_message(self, format, *args):
+        return
+
+
+def serve_locally(handler=LocalApiHandler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def bench_http(calls=300):
+    """Fresh connection per call (module-level requests.post) vs. the shared keep-alive client."""
+    server, url = serve_locally()
+    client = HttpClient(
+        {
+            "local": {
+                "timeout": (2, 5),
+                "retries": 0,
+                "backoff_factor": 0,
+                "pool_size": 1,
+            }
+        }
+    )
+    start = time.perf_counter()
+    for _ in range(calls):
+        requests.post(url, data="[[0]]", timeout=5)
+    fresh_cost = (time.perf_counter() - start) / calls
+
+    start = time.perf_counter()
+    for _ in range(calls):
+        client.post("local", url, data="[[0]]")
+    pooled_cost = (time.perf_counter() - start) / calls
+    server.shutdown()
+
+    print(f"requests.post per call:  {fresh_cost * 1e6:.0f} us")
+    print(
+        f"shared client per call:  {pooled_cost * 1e6:.0f} us, {client.stats()['local']}"
+    )
+
+
+class FakeTwilioHandler(LocalApiHandler):
+    """Stands in for the Twilio Messages API, with a typical round trip of latency."""
+
+    response_body = json.dumps({"sid": "SM" + "0" * 32, "status": "queued"}).encode()
+    response_status = 201
+    response_delay = 0.08
+
+
+def bench_broadcast(recipients=50, rate_per_second=100):
+    """Serial messages.create per guest vs. the concurrent, rate-limited OutboundMessenger."""
+    server, url = serve_locally(FakeTwilioHandler)
+    twilio = Client("AC" + "0" * 32, "token")
+    twilio.api.base_url = url
+    numbers = [f"+1555{i:07d}" for i in range(recipients)]
+
+    start = time.perf_counter()
+    for number in numbers:
+        twilio.messages.create(to=number, from_="+15550000000", body="hello")
+    serial_cost = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as backup_dir:
+        messenger = OutboundMessenger(
+            twilio,
+            "+15550000000",
+            rate_per_second=rate_per_second,
+            burst=10,
+            backup_dir=backup_dir,
+        )
+        start = time.perf_counter()
+        broadcast = messenger.broadcast(numbers, "hello")
+        returned_after = time.perf_counter() - start
+        broadcast.wait()
+        concurrent_cost = time.perf_counter() - start
+        messenger.close()
+    server.shutdown()
+
+    print(f"serial, {recipients} guests:     {serial_cost:.2f} s")
+    print(
+        f"messenger, {recipients} guests:  {concurrent_cost:.2f} s "
+        f"(caller free after {returned_after * 1e3:.1f} ms, {rate_per_second}/s limit), "
+        f"{broadcast.summary()}"
+    )
+
+
+def bench_outbound_queue(messages=2000):
+    """Cost of Logic.send_msg's enqueue, which the BLE countdown path waits on."""
+    with tempfile.TemporaryDirectory() as backup_dir:
+        messenger = OutboundMessenger(None, "+15550000000", backup_dir=backup_dir)
+        # keep the workers from draining the queue while it is being measured
+        messenger.close()
+        start = time.perf_counter()
+        for i in range(messages):
+            messenger.enqueue(f"+1555{i % 50:07d}", "keep blowing")
+        enqueue_cost = (time.perf_counter() - start) / messages
+        messenger.queue.close()
+
+        restart_start = time.perf_counter()
+        restored = OutboundQueue(backup_dir)
+        restart_cost = time.perf_counter() - restart_start
+
+    print(f"enqueue, journaled:      {enqueue_cost * 1e6:.1f} us per message")
+    print(f"restart with {len(restored)} pending:  {restart_cost * 1e3:.1f} ms")
+
+
+async def simulated_test(device, stage_timeouts=None):
+    """One BacTrack test against the simulator, returns (reading or exception, time it ended)."""
+    bac_track = BacTrack(
+        "SIMULATED",
+        client_factory=client_factory(device),
+        stage_timeouts=stage_timeouts or {0: 2, 1: 2, 2: 2, 3: 2, 4: 2},
+    )
+    await bac_track.bluetooth_connect()
+    try:
+        outcome = await bac_track.conduct_test(lambda *args: None, "SIMULATED")
+    except Exception as e:
+        outcome = e
+    return outcome, time.monotonic()
+
+
+def bench_ble(speed=20.0):
+    """How fast a simulated test ends on results, a dropped link and a stalled device."""
+    device = SimulatedBreathalyzer(speed=speed, connect_seconds=0, seed=1)
+    start = time.monotonic()
+    reading, ended_at = asyncio.run(simulated_test(device))
+    print(
+        f"results:     {reading} after {ended_at - start:.2f} s at {speed:.0f}x "
+        f"(includes start_test's 1 s settle)"
+    )
+
+    device = SimulatedBreathalyzer(
+        speed=speed, connect_seconds=0, disconnect_at_stage=3, seed=1
+    )
+    error, ended_at = asyncio.run(simulated_test(device))
+    print(
+        f"disconnect:  noticed {(ended_at - device.disconnected_at) * 1e3:.2f} ms after the drop "
+        f"(the old poll checked once a second)"
+    )
+
+    stall_timeout = 0.5
+    device = SimulatedBreathalyzer(
+        speed=speed, connect_seconds=0, stall_at_stage=4, seed=1
+    )
+    error, ended_at = asyncio.run(
+        simulated_test(device, {stage: stall_timeout for stage in range(5)})
+    )
+    lateness = ended_at - device.last_frame_at - stall_timeout
+    print(
+        f"stall:       noticed {lateness * 1e3:.2f} ms past the {stall_timeout} s stage timeout"
+    )
+
+    device = SimulatedBreathalyzer(
+        speed=speed, connect_seconds=0, drop_rate=0.2, seed=3
+    )
+    outcome, ended_at = asyncio.run(simulated_test(device))
+    print(
+        f"20% drops:   {outcome!r}, {device.frames_dropped} of "
+        f"{device.frames_dropped + device.frames_sent} frames lost"
+    )
+
+
+def if_chain_decode(data):
+    """The old test_results_listener decode: per-byte indexing, an if per stage and a float round trip."""
+    if len(data) != 13:
+        return None
+    stage = data[2] & 0x0F
+    countdown = data[5] & 0x0F
+    description = ""
+    if stage == 1:
+        description = "WARMING_UP"
+    if stage == 2:
+        description == "BEGIN_BLOWING"
+    if stage == 3:
+        description = "KEEP_BLOWING"
+        if countdown == 0:
+            description = "STOP_BLOWING"
+    if stage == 4:
+        description = "PROCESSING"
+    if stage == 5:
+        description = "ATTAINED_RESULTS"
+        reading = ((data[3] & 255) * 256 + (data[4] & 255)) / 10000.0
+        countdown = f"{float(reading):.3f}"
+    return description, countdown
+
+
+def bench_frames(rounds=10000):
+    """Decode cost of the old if-chain vs. the table-driven decoder, per frame kind and per test.
+
+    Correctness and the fuzz pass over malformed payloads live in test_bactrack_frames.py.
+    """
+    device = SimulatedBreathalyzer()
+    frames = [bytearray(frame) for _, frame in device.script()]
+
+    def best_of(decode, payloads):
+        # best of a few runs, a single pass is at the mercy of whatever else the box is doing
+        best = float("inf")
+        for _ in range(5):
+            start = time.perf_counter()
+            for _ in range(rounds):
+                for payload in payloads:
+                    decode(payload)
+            best = min(best, (time.perf_counter() - start) / rounds)
+        return best
+
+    for name, decode in (("if-chain", if_chain_decode), ("table", decode_frame)):
+        per_progress = best_of(decode, frames[:-1]) / (len(frames) - 1)
+        per_result = best_of(decode, frames[-1:])
+        per_test = best_of(decode, frames)
+        print(
+            f"{name:<9} {per_progress * 1e9:5.0f} ns per progress frame, "
+            f"{per_result * 1e9:5.0f} ns for the result frame, "
+            f"{per_test * 1e6:5.2f} us per test ({len(frames)} frames)"
+        )
+
+
+def bench_pool(guests=6, device_counts=(1, 2, 3), speed=50.0):
+    """Throughput of the breathalyzer line as simulated devices are added to the pool."""
+
+    async def drain_line(device_count):
+        pool = BreathalyzerPool(
+            [
+                BacTrack(
+                    f"SIMULATED-{i}",
+                    client_factory=client_factory(
+                        SimulatedBreathalyzer(speed=speed, connect_seconds=0, seed=i)
+                    ),
+                )
+                for i in range(device_count)
+            ]
+        )
+
+        async def run_test(client_number, device):
+            await device.ble.ensure_connected()
+            await device.bac_track.conduct_test(lambda *args: None, client_number)
+
+        scheduler = TestScheduler(run_test, lambda *args: None, pool)
+        start = time.monotonic()
+        for guest in range(guests):
+            scheduler.request(f"+1555000{guest:04d}")
+        while scheduler.completed_tests < guests:
+            await asyncio.sleep(0.01)
+        return time.monotonic() - start
+
+    baseline = None
+    for device_count in device_counts:
+        elapsed = asyncio.run(drain_line(device_count))
+        baseline = baseline or elapsed
+        print(
+            f"{device_count} device(s): {guests} tests in {elapsed:5.2f} s at {speed:.0f}x, "
+            f"{baseline / elapsed:.2f}x the single-device throughput"
+        )
+
+
+def bench_stage_timing(spans=100000):
+    """Overhead stage timing adds to every instrumented stage, and the cost of the admin summary."""
+    timings = StageTimings(window=500)
+    start = time.perf_counter()
+    for _ in range(spans):
+        timings.record("record", 0.001)
+    record_cost = (time.perf_counter() - start) / spans
+    start = time.perf_counter()
+    for _ in range(spans):
+        with timings.span("span"):
+            pass
+    span_cost = (time.perf_counter() - start) / spans
+    for stage in range(12):
+        for sample in range(500):
+            timings.record(f"stage_{stage}", sample / 1000)
+    start = time.perf_counter()
+    timings.summary()
+    summary_cost = time.perf_counter() - start
+    print(f"record:   {record_cost * 1e9:.0f} ns")
+    print(f"span:     {span_cost * 1e9:.0f} ns")
+    print(f"summary:  {summary_cost * 1e3:.2f} ms for 14 stages x 500 samples")
+
+
+def bench_metrics(updates=100000, label_values=20):
+    """Hot-path cost of a counter increment and a histogram observation, and of one /metrics scrape."""
+    registry = MetricsRegistry()
+    counter = Counter(
+        "bench_total", "Benchmark counter.", ["outcome"], registry=registry
+    )
+    histogram = Histogram(
+        "bench_seconds", "Benchmark histogram.", ["stage"], registry=registry
+    )
+    start = time.perf_counter()
+    for _ in range(updates):
+        counter.labels("accepted").inc()
+    inc_cost = (time.perf_counter() - start) / updates
+    start = time.perf_counter()
+    for i in range(updates):
+        histogram.labels("test").observe(i % 1000 / 100)
+    observe_cost = (time.perf_counter() - start) / updates
+    for i in range(label_values):
+        histogram.labels(f"stage_{i}").observe(0.1)
+    start = time.perf_counter()
+    lines = registry.render().count("\n")
+    render_cost = time.perf_counter() - start
+    print(f"counter inc:        {inc_cost * 1e9:.0f} ns")
+    print(f"histogram observe:  {observe_cost * 1e9:.0f} ns")
+    print(f"scrape:             {render_cost * 1e3:.2f} ms for {lines} lines")
+
+
+class StallingFile:
+    """A log file on an SD card: writes are cheap until write-back stalls a flush now and then."""
+
+    def __init__(self, path, stall_every=200, stall_seconds=0.02):
+        self.file = open(path, "w")
+        self.stall_every = stall_every
+        self.stall_seconds = stall_seconds
+        self.flushes = 0
+
+    def write(self, text):
+        return self.file.write(text)
+
+    def flush(self):
+        self.file.flush()
+        self.flushes += 1
+        if self.flushes % self.stall_every == 0:
+            time.sleep(self.stall_seconds)
+
+    def close(self):
+        self.file.close()
+
+
+def bench_logging(records=5000, payload_chars=5000):
+    """Caller-side log latency on a stalling disk, written inline vs. handed to the queued writer."""
+    payload = "x" * payload_chars
+    logging.disable(
+        logging.NOTSET
+    )  # the runner silences logging for every other benchmark
+    logger = logging.getLogger("bench_logging")
+    logger.propagate = False
+    with tempfile.TemporaryDirectory() as log_dir:
+        direct_file = StallingFile(os.path.join(log_dir, "direct.txt"))
+        queued_file = StallingFile(os.path.join(log_dir, "queued.txt"))
+        log_queue = queue.Queue(maxsize=records)
+        listener = logging.handlers.QueueListener(
+            log_queue, logging.StreamHandler(queued_file)
+        )
+        listener.start()
+        for name, handler, body in (
+            ("direct, full payload", logging.StreamHandler(direct_file), payload),
+            (
+                "direct, truncated",
+                logging.StreamHandler(direct_file),
+                truncate(payload),
+            ),
+            ("queued, truncated", DroppingQueueHandler(log_queue), truncate(payload)),
+        ):
+            logger.handlers = [handler]
+            latencies = []
+            for i in range(records):
+                start = time.perf_counter()
+                logger.warning(f"VBML response {i}: {body}")
+                latencies.append(time.perf_counter() - start)
+            latencies.sort()
+            print(
+                f"{name:<22} mean {sum(latencies) / records * 1e6:6.1f} us, "
+                f"p99 {percentile(latencies, 99) * 1e6:7.1f} us, max {latencies[-1] * 1e3:5.1f} ms"
+            )
+        listener.stop()
+        direct_file.close()
+        queued_file.close()
+    logging.disable(logging.CRITICAL)
+
+
+benchmarks = {
+    "journal": bench_journal,
+    "writer": bench_writer,
+    "restore": bench_restore,
+    "user_memory": bench_user_memory,
+    "leaderboard": bench_leaderboard,
+    "vbml": bench_vbml,
+    "http": bench_http,
+    "broadcast": bench_broadcast,
+    "outbound_queue": bench_outbound_queue,
+    "ble": bench_ble,
+    "frames": bench_frames,
+    "pool": bench_pool,
+    "stage_timing": bench_stage_timing,
+    "metrics": bench_metrics,
+    "logging": bench_logging,
+}
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    parser = argparse.ArgumentParser(description="Party client microbenchmarks")
+    parser.add_argument("names", nargs="*", help=f"any of {list(benchmarks)}")
+    chosen = parser.parse_args().names or list(benchmarks)
+    unknown = set(chosen) - set(benchmarks)
+    if unknown:
+        parser.error(f"unknown benchmarks: {sorted(unknown)}")
+    for name in chosen:
+        print(f"== {name} ==")
+        benchmarks[name]()
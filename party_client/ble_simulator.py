@@ -0,0 +1,245 @@
+import asyncio
+import functools
+import json
+import logging
+import random
+import sys
+import time
+
+from bleak.exc import BleakError
+
+from bactrack_frames import frame_layout
+from globals import bactrack_metadata
+
+# GATT writes BacTrack sends, see BacTrack.start_test and BacTrack.end_test
+initialize_step_one = bytes.fromhex("000100")
+initialize_step_two = bytes.fromhex("000130")
+start_test_command = bytes.fromhex("027203e0")
+
+
+def encode_frame(stage, countdown=0, reading=0):
+    """13-byte notification the way the device lays it out; bytes the app never reads stay zero.
+
+    reading is in ten-thousandths of BAC, so 450 is 0.045.
+    """
+    return frame_layout.pack(stage & 0x0F, reading, countdown & 0x0F)
+
+
+class SimulatedBreathalyzer:
+    """Scripted BACtrack: the frames a test produces, their timing, and how unreliable the link is.
+
+    Either generates a stage 1-5 script from the knobs below, or replays a trace
+    captured from a real device with save_trace. speed > 1 runs faster than real time.
+    """
+
+    def __init__(
+        self,
+        reading="0.045",
+        warmup_ticks=5,
+        blow_ticks=5,
+        processing_frames=2,
+        frame_interval=1.0,
+        blow_delay=2.0,
+        jitter=0.1,
+        drop_rate=0.0,
+        disconnect_at_stage=None,
+        stall_at_stage=None,
+        battery_percentage=80,
+        connect_seconds=1.5,
+        speed=1.0,
+        trace=None,
+        seed=None,
+    ):
+        self.reading = reading
+        self.warmup_ticks = warmup_ticks
+        self.blow_ticks = blow_ticks
+        self.processing_frames = processing_frames
+        self.frame_interval = frame_interval
+        self.blow_delay = blow_delay  # how long the guest takes to start blowing
+        self.jitter = jitter  # fraction of each delay, randomized both ways
+        self.drop_rate = drop_rate  # chance a frame never arrives
+        # the link drops, or the device goes quiet, as this stage begins
+        self.disconnect_at_stage = disconnect_at_stage
+        self.stall_at_stage = stall_at_stage
+        self.battery_percentage = battery_percentage
+        self.connect_seconds = connect_seconds
+        self.speed = speed
+        # [(seconds since previous frame, frame bytes)], replaces the script
+        self.trace = trace
+        self.random = random.Random(seed)
+
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.disconnected_at = None  # monotonic time the simulated link dropped
+        self.last_frame_at = None
+
+    def script(self):
+        """(delay before it, frame) pairs for one test."""
+        if self.trace is not None:
+            yield from self.trace
+            return
+        for countdown in range(self.warmup_ticks, 0, -1):
+            yield self.frame_interval, encode_frame(1, countdown)
+        yield self.frame_interval, encode_frame(2)
+        yield self.blow_delay, encode_frame(3, self.blow_ticks)
+        for countdown in range(self.blow_ticks - 1, -1, -1):
+            yield self.frame_interval, encode_frame(3, countdown)
+        for _ in range(self.processing_frames):
+            yield self.frame_interval, encode_frame(4)
+        yield self.frame_interval, encode_frame(
+            5, reading=round(float(self.reading) * 10000)
+        )
+
+    def delay(self, seconds):
+        # a replayed trace already carries the real device's timing
+        spread = 0.0 if self.trace is not None else seconds * self.jitter
+        return max(0.0, seconds + self.random.uniform(-spread, spread)) / self.speed
+
+
+class FakeBleakClient:
+    """Stands in for bleak.BleakClient, talking to a SimulatedBreathalyzer instead of a radio.
+
+    Build it through client_factory(device) so BacTrack can create it like a BleakClient.
+    """
+
+    def __init__(
+        self,
+        device,
+        address_or_ble_device=None,
+        timeout=10.0,
+        disconnected_callback=None,
+    ):
+        self.device = device
+        self.address = address_or_ble_device
+        self.timeout = timeout
+        self.disconnected_callback = disconnected_callback
+        self.connected = False
+        self.notify_callbacks = {}  # characteristic -> callback(sender, data)
+        self.init_steps = []
+        self.writes = []  # every (characteristic, bytes) written, for assertions
+        self.emitter = None
+
+    @property
+    def is_connected(self):
+        return self.connected
+
+    async def connect(self):
+        await asyncio.sleep(self.device.connect_seconds / self.device.speed)
+        self.connected = True
+        return True
+
+    async def disconnect(self):
+        self.drop_link()
+        return True
+
+    def drop_link(self):
+        if not self.connected:
+            return
+        self.connected = False
+        self.notify_callbacks.clear()
+        if self.emitter is not None and self.emitter is not asyncio.current_task():
+            self.emitter.cancel()
+        self.emitter = None
+        if self.disconnected_callback is not None:
+            self.disconnected_callback(self)
+
+    def require_connection(self):
+        if not self.connected:
+            raise BleakError("Not connected")
+
+    async def read_gatt_char(self, characteristic):
+        self.require_connection()
+        if characteristic == bactrack_metadata["BATTERY_LEVEL_CHARACTERISTIC_UUID"]:
+            return bytearray([self.device.battery_percentage])
+        return bytearray()
+
+    async def write_gatt_char(self, characteristic, data, response=True):
+        self.require_connection()
+        data = bytes(data)
+        self.writes.append((characteristic, data))
+        if data in (initialize_step_one, initialize_step_two):
+            if data == initialize_step_one:
+                self.init_steps = []
+            self.init_steps.append(data)
+            if self.emitter is not None:
+                # the end-of-test writes reset the device
+                self.emitter.cancel()
+                self.emitter = None
+        elif data == start_test_command:
+            if self.init_steps != [initialize_step_one, initialize_step_two]:
+                raise BleakError("Test started before the device was initialized")
+            self.emitter = asyncio.create_task(self.emit())
+
+    async def start_notify(self, characteristic, callback):
+        self.require_connection()
+        self.notify_callbacks[characteristic] = callback
+
+    async def stop_notify(self, characteristic):
+        self.require_connection()
+        self.notify_callbacks.pop(characteristic, None)
+
+    async def emit(self):
+        device = self.device
+        characteristic = bactrack_metadata["TEST_RESULTS_LISTENER_UUID"]
+        for delay, frame in device.script():
+            await asyncio.sleep(device.delay(delay))
+            stage = frame[2] & 0x0F if len(frame) > 2 else None
+            if stage == device.disconnect_at_stage:
+                device.disconnected_at = time.monotonic()
+                self.drop_link()
+                return
+            if stage == device.stall_at_stage:
+                return
+            if device.random.random() < device.drop_rate:
+                device.frames_dropped += 1
+                continue
+            callback = self.notify_callbacks.get(characteristic)
+            if callback is not None:
+                device.frames_sent += 1
+                device.last_frame_at = time.monotonic()
+                callback(characteristic, bytearray(frame))
+
+
+def client_factory(device):
+    """Drop-in for BacTrack's client_factory, every client it builds talks to device."""
+    return functools.partial(FakeBleakClient, device)
+
+
+def save_trace(trace_file, notification_trace):
+    """Write BacTrack.notification_trace as [seconds since previous frame, hex] pairs."""
+    rows, previous = [], None
+    for received_at, frame in notification_trace:
+        rows.append([0.0 if previous is None else received_at - previous, frame.hex()])
+        previous = received_at
+    with open(trace_file, "w") as trace:
+        json.dump(rows, trace, indent=4)
+
+
+def load_trace(trace_file):
+    with open(trace_file, "r") as trace:
+        return [(delay, bytes.fromhex(frame)) for delay, frame in json.load(trace)]
+
+
+if __name__ == "__main__":
+    # python3 ble_simulator.py [trace.json] [speed]: one simulated test, printed stage by stage
+    from breathalyzer_client import BacTrack
+
+    logging.basicConfig(level=logging.WARNING)
+    trace = load_trace(sys.argv[1]) if len(sys.argv) > 1 else None
+    speed = float(sys.argv[2]) if len(sys.argv) > 2 else 10.0
+
+    async def simulate():
+        device = SimulatedBreathalyzer(speed=speed, trace=trace)
+        bac_track = BacTrack("SIMULATED", client_factory=client_factory(device))
+        await bac_track.bluetooth_connect()
+        start = time.monotonic()
+        reading = await bac_track.conduct_test(
+            lambda description, countdown, number: print(
+                f"{time.monotonic() - start:6.2f}s  {description:<16} {countdown}"
+            ),
+            "SIMULATED",
+        )
+        print(f"Reading {reading} after {time.monotonic() - start:.2f}s at {speed}x")
+        await bac_track.bluetooth_disconnect()
+
+    asyncio.run(simulate())
@@ -1,13 +1,121 @@
 import asyncio
 import time
 from asyncio import sleep
+from collections import deque
 from bleak import BleakClient
 from bleak.exc import BleakError, BleakDeviceNotFoundError
+from bactrack_frames import Stage, decode_frame, results_stage
 from globals import bactrack_metadata
+from log_setup import LogRateLimiter
+from stage_timing import stage_timings
 from tenacity import retry, stop_after_attempt, wait_fixed
 
 import logging
 
+# upper voltage bound of each battery state, as the old two-read check classified them
+battery_voltage_bands = (
+    (3.7, "Low"),
+    (3.8, "Medium Low"),
+    (4.0, "Medium"),
+    (5.9, "High"),
+)
+
+# stage_timings name for the time spent in each stage, None is before the first notification
+stage_span_names = {
+    None: "first_notification",
+    Stage.WARMING_UP: "warm_up",
+    Stage.BEGIN_BLOWING: "wait_for_blow",
+    Stage.KEEP_BLOWING: "blowing",
+    Stage.PROCESSING: "processing",
+}
+
+
+class BatteryMonitor:
+    """TTL-cached battery state with an exponentially smoothed voltage.
+
+    Every battery read feeds it, so the connection manager's keep-alive reads
+    double as a low-frequency background sampler and starting a test never has
+    to wait on GATT reads just to check the battery.
+    """
+
+    def __init__(
+        self,
+        ttl=bactrack_metadata["battery_cache_ttl_seconds"],
+        smoothing=bactrack_metadata["battery_smoothing"],
+        history_size=bactrack_metadata["battery_history_size"],
+    ):
+        self.ttl = ttl
+        self.smoothing = smoothing
+        self.voltage = None  # smoothed
+        self.percentage = None  # latest raw reading
+        self.sampled_at = None
+        self.history = deque(maxlen=history_size)  # (time, smoothed voltage)
+        self.tests = 0
+        self.first_test_sample = (
+            None  # (tests so far, smoothed voltage) once a test has run
+        )
+
+    def record(self, percentage, voltage):
+        self.percentage = percentage
+        self.sampled_at = time.monotonic()
+        if self.voltage is None:
+            self.voltage = voltage
+        else:
+            self.voltage += self.smoothing * (voltage - self.voltage)
+        self.history.append((self.sampled_at, self.voltage))
+
+    def record_test(self):
+        self.tests += 1
+        if self.first_test_sample is None and self.voltage is not None:
+            self.first_test_sample = (self.tests, self.voltage)
+
+    def is_fresh(self):
+        return (
+            self.sampled_at is not None
+            and time.monotonic() - self.sampled_at <= self.ttl
+        )
+
+    def state(self):
+        if not self.is_fresh():
+            return "Invalid"
+        for upper_bound, state in battery_voltage_bands:
+            if self.voltage <= upper_bound:
+                return state
+        return "Invalid"
+
+    def trend_per_hour(self):
+        """Smoothed voltage change per hour over the kept history, None until there is enough of it."""
+        if len(self.history) < 2:
+            return None
+        (first_at, first_voltage), (last_at, last_voltage) = (
+            self.history[0],
+            self.history[-1],
+        )
+        if last_at - first_at < 60:
+            return None
+        return (last_voltage - first_voltage) * 3600 / (last_at - first_at)
+
+    def estimated_remaining_tests(self):
+        """Tests left before the battery reads Low, from the drain per test seen so far."""
+        if self.first_test_sample is None or self.voltage is None:
+            return None
+        tests_then, voltage_then = self.first_test_sample
+        drain_per_test = (voltage_then - self.voltage) / max(1, self.tests - tests_then)
+        if drain_per_test <= 0:
+            return None
+        low_voltage = battery_voltage_bands[0][0]
+        return max(0, int((self.voltage - low_voltage) / drain_per_test))
+
+    def stats(self):
+        return {
+            "state": self.state(),
+            "percentage": self.percentage,
+            "smoothed_voltage": self.voltage,
+            "volts_per_hour": self.trend_per_hour(),
+            "estimated_remaining_tests": self.estimated_remaining_tests(),
+            "tests": self.tests,
+        }
+
 
 class BacTrack:
     def __init__(
@@ -21,6 +129,8 @@ class BacTrack:
         ],
         start_test_uuid=bactrack_metadata["START_TEST_UUID"],
         test_results_listener_uuid=bactrack_metadata["TEST_RESULTS_LISTENER_UUID"],
+        client_factory=BleakClient,
+        stage_timeouts=bactrack_metadata["stage_timeouts_seconds"],
     ):
         self.BATTERY_LEVEL_CHARACTERISTIC_UUID = battery_level_characteristic_uuid
         self.CONNECTION_INITIALIZATION_UUID = connection_initialization_uuid
@@ -28,67 +138,77 @@ class BacTrack:
         self.TEST_RESULTS_LISTENER_UUID = test_results_listener_uuid
 
         self.device_bluetooth_address = device_bluetooth_address
+        self.client_factory = client_factory  # BleakClient, or ble_simulator's fake for hardware-free runs
         self.client = None
+        self.disconnected_callback = None  # set by BleConnectionManager
+        self.battery = BatteryMonitor()
 
+        self.stage_timeouts = stage_timeouts
         self.is_test_running = False
+        self.is_notifying = False
+        self.test_outcome = None  # future settled by results, disconnect or stall
+        self.watchdog = None  # loop timer that fails the test when a stage goes quiet
         self.last_read_notification_timestamp = None
         self.stage = None
+        self.stage_started_at = None  # perf_counter when the current stage began
+        self.notification_log = (
+            LogRateLimiter()
+        )  # notifications arrive several times a second
+        self.notification_trace = (
+            None  # set to a list to capture (time, frame) pairs for ble_simulator
+        )
 
-    async def check_connection(self):
-        # This function actively checks if the client is still connected
-        try:
-            while self.is_test_running:
-                if not self.client.is_connected:
-                    logging.error("Device unexpectedly disconnected!")
-                    raise Exception("Device unexpectedly disconnected!")
-                if (
-                    self.stage
-                    and self.stage > 1
-                    and self.stage <= 3
-                    and time.time() - self.last_read_notification_timestamp
-                    > bactrack_metadata["read_notifications_timeout_duration"]
-                ):
-                    logging.error(
-                        "Did not get a read_notification from device in greater than threshold."
-                    )
-                    raise Exception(
-                        "Did not get a read_notification from device in greater than threshold."
-                    )
-                await asyncio.sleep(1)  # check for connection open every 2 seconds
+    def handle_disconnect(self, client):
+        # Bleak calls this on the loop thread the moment the link drops
+        if client is not self.client:
             return
-        except Exception as e:
-            logging.error(f"Exception in check_connection: {e}")
-            raise Exception(f"Exception in check_connection: {e}")
+        self.fail_test("Device unexpectedly disconnected!")
+        if self.disconnected_callback is not None:
+            self.disconnected_callback(client)
 
-    async def get_battery_state(self):
-        try:
-            prev_pct = await self.get_battery_percentage()
-            previous_voltage = self.battery_pct_to_voltage(prev_pct)
-            await sleep(0.5)
-            curr_pct = await self.get_battery_percentage()
-            curr_voltage = self.battery_pct_to_voltage(curr_pct)
-            battery_state = "Invalid"
-            if curr_voltage <= 3.7 and previous_voltage <= 3.7:
-                battery_state = "Low"
-            elif 3.7 < curr_voltage <= 3.8 and 3.7 < previous_voltage <= 3.8:
-                battery_state = "Medium Low"
-            elif 3.8 < curr_voltage <= 4.0 and 3.8 < previous_voltage <= 4.0:
-                battery_state = "Medium"
-            elif 4.0 < curr_voltage <= 5.9 and 4.0 < previous_voltage <= 5.9:
-                battery_state = "High"
-            logging.info(f"Read battery state of {battery_state}")
-            return battery_state
-        except BleakError as e:
-            logging.error(f"Error reading battery state: {e}")
-            return "Invalid"
+    def fail_test(self, reason):
+        # results, disconnect and stall all race to settle the same future, the first one wins
+        if self.test_outcome is not None and not self.test_outcome.done():
+            logging.error(reason)
+            self.test_outcome.set_exception(Exception(reason))
+
+    def arm_watchdog(self, stage):
+        """(Re)start the stall timer for the current stage, every notification pushes it back."""
+        if self.watchdog is not None:
+            self.watchdog.cancel()
+        timeout = self.stage_timeouts.get(stage)
+        if timeout is not None:
+            self.watchdog = asyncio.get_running_loop().call_later(
+                timeout,
+                self.fail_test,
+                f"Did not get a read_notification from device in stage {stage} for {timeout}s.",
+            )
+
+    def disarm_watchdog(self):
+        if self.watchdog is not None:
+            self.watchdog.cancel()
+            self.watchdog = None
+
+    async def cached_battery_state(self):
+        """Battery state from the cache, one fresh read only when the cache has gone stale."""
+        with stage_timings.span("battery_check"):
+            if not self.battery.is_fresh():
+                try:
+                    await self.get_battery_percentage()
+                except Exception as e:
+                    logging.error(f"Error refreshing battery state: {e}")
+        battery_state = self.battery.state()
+        logging.info(f"Battery state is {battery_state}")
+        return battery_state
 
     @retry(stop=stop_after_attempt(2), wait=wait_fixed(2))
     async def bluetooth_connect(self):
         try:
             if not self.client or not self.client.is_connected:
-                self.client = BleakClient(
+                self.client = self.client_factory(
                     address_or_ble_device=self.device_bluetooth_address,
                     timeout=bactrack_metadata["connection_timeout_duration"],
+                    disconnected_callback=self.handle_disconnect,
                 )
                 await self.client.connect()
                 logging.info("Connected to breathalyzer")
@@ -106,8 +226,10 @@ class BacTrack:
                 battery_level = await self.client.read_gatt_char(
                     self.BATTERY_LEVEL_CHARACTERISTIC_UUID
                 )
-                logging.info(f"Read battery percentage of {int(battery_level[0])}%")
-                return int(battery_level[0])
+                percentage = int(battery_level[0])
+                logging.info(f"Read battery percentage of {percentage}%")
+                self.battery.record(percentage, self.battery_pct_to_voltage(percentage))
+                return percentage
         except BleakError as e:
             logging.error(f"Error reading battery percentage: {e}")
             raise BleakError(f"Error reading battery percentage: {e}")
@@ -158,45 +280,44 @@ class BacTrack:
 
     async def conduct_test(self, message_callback, client_number):
         try:
-            if self.client.is_connected and await self.get_battery_state() not in [
+            if self.client.is_connected and await self.cached_battery_state() not in [
                 "Invalid",
                 "Low",
             ]:
-                await self.start_test()
+                with stage_timings.span("start_test"):
+                    await self.start_test()
 
                 logging.info(
                     f"Starting notification listener on breathalyzer characteristic: {self.TEST_RESULTS_LISTENER_UUID}"
                 )
 
-                test_results_future = asyncio.Future()
+                test_results_future = asyncio.get_running_loop().create_future()
+                self.test_outcome = test_results_future
+                self.is_test_running = True
+                self.arm_watchdog(0)
+                self.stage_started_at = time.perf_counter()
                 await self.client.start_notify(
                     self.TEST_RESULTS_LISTENER_UUID,
                     lambda sender, data: self.test_results_listener(
                         data, message_callback, client_number, test_results_future
                     ),
                 )
-                self.is_test_running = True
-
-                await asyncio.create_task(self.check_connection())
-
-                done, pending = await asyncio.wait(
-                    [
-                        test_results_future,  # Wait directly for the existing Future
-                        asyncio.create_task(asyncio.sleep(60)),
-                    ],
-                    return_when=asyncio.FIRST_COMPLETED,
-                )
+                self.is_notifying = True
 
-                results = "Error occured during BAC test"
-                if test_results_future.done() and test_results_future.result():
-                    logging.info("Test end criterion reached: attained test results")
-                    results = test_results_future.result()
-                else:
-                    logging.warning(
+                try:
+                    async with asyncio.timeout(
+                        bactrack_metadata["test_timeout_duration"]
+                    ):
+                        results = await test_results_future
+                except TimeoutError:
+                    raise Exception(
                         "Test end criterion reached: hit test timeout duration"
                     )
+                logging.info("Test end criterion reached: attained test results")
                 await self.end_test()
+                self.battery.record_test()
                 return results
+            raise Exception("Breathalyzer is disconnected or its battery is low")
         except Exception as e:
             logging.error(f"Error while conducting breathalyzer test: {e}")
             await self.end_test()
@@ -206,60 +327,66 @@ class BacTrack:
         self, data, message_callback, client_number, test_results_future
     ):
         self.last_read_notification_timestamp = time.time()
-        if self.client.is_connected and self.is_test_running:
-            logging.info("Bytes received on breathalyzer test listener")
-
-            if len(data) != 13:
+        if self.notification_trace is not None:
+            self.notification_trace.append(
+                (self.last_read_notification_timestamp, bytes(data))
+            )
+        if (
+            self.client.is_connected
+            and self.is_test_running
+            and not test_results_future.done()
+        ):
+            frame = decode_frame(data)
+            if frame is None:
                 logging.warning("Invalid data received on breathalyzer test listener")
                 return
 
-            stage = data[2] & 0x0F
-            self.stage = stage
-            countdown = data[5] & 0x0F
-
-            description = ""
-            if stage == 1:
-                description = "WARMING_UP"
-            if stage == 2:
-                description == "BEGIN_BLOWING"
-            if stage == 3:
-                description = "KEEP_BLOWING"
-                if countdown == 0:
-                    description = "STOP_BLOWING"
-            if stage == 4:
-                description = "PROCESSING"
-            if stage == 5:
-                description = "ATTAINED_RESULTS"
-                reading = ((data[3] & 255) * 256 + (data[4] & 255)) / 10000.0
-                reading = f"{float(reading):.3f}"
+            if frame.stage != self.stage:
+                now = time.perf_counter()
+                stage_timings.record(
+                    stage_span_names[self.stage], now - self.stage_started_at
+                )
+                self.stage_started_at = now
+                logging.info(f"Breathalyzer test entered stage {frame.description}")
+            self.stage = frame.stage
+            self.arm_watchdog(frame.stage)
+            description = frame.description
+            countdown = frame.countdown
+
+            if frame.stage is results_stage:
+                reading = frame.reading
+                self.disarm_watchdog()
                 test_results_future.set_result(reading)
-                self.is_test_running = False
                 logging.info(f"Attained BAC reading of {reading}")
                 countdown = reading
 
-            print(
-                f"Stage description: {description}, with countdown/reading: {countdown}"
-            )  # eventually comment out
             message_callback(description, str(countdown), client_number)
 
-            logging.info(
-                f"Stage description: {description}, with countdown/reading: {countdown}"
-            )
+            if self.notification_log.allow():
+                logging.debug(
+                    f"Stage description: {description}, with countdown/reading: {countdown} "
+                    f"({self.notification_log.take_suppressed()} notifications since the last line)"
+                )
             return countdown
 
     async def end_test(self):
         logging.info("Beginning end breathalyzer test procedure")
 
+        self.disarm_watchdog()
+        self.test_outcome = None
+        was_running = self.is_test_running
+        self.is_test_running = False
+        self.last_read_notification_timestamp = None
+        self.stage = None
+        self.stage_started_at = None
         try:
-            if self.client.is_connected and self.is_test_running:
-                self.is_test_running = False
-                self.last_read_notification_timestamp = None
-                self.stage = None
-
-                logging.info(
-                    f"Stopping notification listener on breathalyzer characteristic: {self.TEST_RESULTS_LISTENER_UUID}"
-                )
-                await self.client.stop_notify(self.TEST_RESULTS_LISTENER_UUID)
+            if self.client.is_connected and was_running:
+                # the link stays up between tests, so the listener has to go even after a result
+                if self.is_notifying:
+                    logging.info(
+                        f"Stopping notification listener on breathalyzer characteristic: {self.TEST_RESULTS_LISTENER_UUID}"
+                    )
+                    await self.client.stop_notify(self.TEST_RESULTS_LISTENER_UUID)
                 await self.client.write_gatt_char(
                     self.CONNECTION_INITIALIZATION_UUID, bytes.fromhex("000130")
                 )
@@ -270,3 +397,240 @@ class BacTrack:
                 logging.info("Successfully completed breathalyzer test ending step 2")
         except BleakError as e:
             logging.error(f"Error during breathalyzer test end: {e}")
+        finally:
+            self.is_notifying = False
+
+
+class BleConnectionManager:
+    """Keeps the BLE link to the breathalyzer warm between tests instead of connecting for every blow.
+
+    Runs as a task on the event loop that drives BLE. It connects as soon as
+    someone asks for the device, reconnects in the background when the link
+    drops, keeps an idle link alive with a periodic battery read, and lets it go
+    after idle_disconnect_seconds without demand.
+    """
+
+    def __init__(
+        self,
+        bac_track,
+        keep_alive_interval=bactrack_metadata["keep_alive_interval_seconds"],
+        idle_disconnect=bactrack_metadata["idle_disconnect_seconds"],
+        reconnect_backoff=bactrack_metadata["reconnect_backoff_seconds"],
+        max_reconnect_backoff=bactrack_metadata["max_reconnect_backoff_seconds"],
+    ):
+        self.bac_track = bac_track
+        self.bac_track.disconnected_callback = self.on_disconnect
+        self.keep_alive_interval = keep_alive_interval
+        self.idle_disconnect = idle_disconnect
+        self.reconnect_backoff = reconnect_backoff
+        self.max_reconnect_backoff = max_reconnect_backoff
+
+        self.task = None
+        self.wake = None  # asyncio.Event, created on the loop in start()
+        self.connected = None  # asyncio.Event
+        self.last_demand = None
+        self.last_keep_alive = 0.0
+        # set while we release an idle link ourselves, so its disconnect callback is no drop
+        self.is_releasing = False
+
+        self.connects = 0
+        self.drops = 0
+        self.connect_seconds = 0.0
+        self.warm_tests = 0
+        self.cold_tests = 0
+
+    async def start(self):
+        """Start the manager on the running loop and ask for a connection, safe to call repeatedly."""
+        if self.task is None:
+            self.wake = asyncio.Event()
+            self.connected = asyncio.Event()
+            self.task = asyncio.create_task(self.run())
+        self.request_connection()
+
+    def request_connection(self):
+        """Someone is about to use the device, connect now if the link is down."""
+        self.last_demand = time.monotonic()
+        if self.wake is not None:
+            self.wake.set()
+
+    def is_connected(self):
+        return self.bac_track.client is not None and self.bac_track.client.is_connected
+
+    async def ensure_connected(self):
+        """Wait until the link is up, returns True when it already was (a warm test)."""
+        await self.start()
+        if self.is_connected():
+            self.warm_tests += 1
+            logging.info(
+                f"Breathalyzer link already warm, saved ~{self.average_connect_seconds() * 1000:.0f} ms of connect"
+            )
+            return True
+        self.cold_tests += 1
+        self.connected.clear()
+        self.wake.set()
+        # covers bluetooth_connect's own two attempts, plus one background backoff
+        async with asyncio.timeout(
+            2 * bactrack_metadata["connection_timeout_duration"]
+            + self.max_reconnect_backoff
+        ):
+            await self.connected.wait()
+        return False
+
+    def on_disconnect(self, client):
+        # called by Bleak on the loop thread
+        if client is not self.bac_track.client:
+            return
+        if self.is_releasing:
+            self.is_releasing = False
+            logging.info("Breathalyzer link released")
+        else:
+            self.drops += 1
+            logging.warning("Breathalyzer link dropped, reconnecting in the background")
+        if self.connected is not None:
+            self.connected.clear()
+        if self.wake is not None:
+            self.wake.set()
+
+    def is_wanted(self):
+        return (
+            self.last_demand is not None
+            and time.monotonic() - self.last_demand < self.idle_disconnect
+        )
+
+    async def run(self):
+        backoff = self.reconnect_backoff
+        while True:
+            self.wake.clear()
+            timeout = self.keep_alive_interval
+            try:
+                if self.bac_track.is_test_running:
+                    pass  # the test owns the link, never touch GATT underneath it
+                elif not self.is_connected():
+                    if self.is_wanted():
+                        await self.connect()
+                        backoff = self.reconnect_backoff
+                elif not self.is_wanted():
+                    logging.info("Breathalyzer idle, releasing the BLE link")
+                    self.is_releasing = True
+                    await self.bac_track.bluetooth_disconnect()
+                elif (
+                    time.monotonic() - self.last_keep_alive >= self.keep_alive_interval
+                ):
+                    await self.keep_alive()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Breathalyzer connection manager error: {e}")
+                timeout = backoff
+                backoff = min(self.max_reconnect_backoff, backoff * 2)
+
+            if self.is_connected():
+                self.connected.set()
+            try:
+                async with asyncio.timeout(timeout):
+                    await self.wake.wait()
+            except TimeoutError:
+                pass
+
+    async def connect(self):
+        self.is_releasing = False  # in case the release never reported its disconnect
+        start = time.monotonic()
+        await self.bac_track.bluetooth_connect()
+        elapsed = time.monotonic() - start
+        self.connects += 1
+        self.connect_seconds += elapsed
+        self.last_keep_alive = time.monotonic()
+        logging.info(f"Breathalyzer link up in {elapsed * 1000:.0f} ms")
+
+    async def keep_alive(self):
+        await self.bac_track.get_battery_percentage()
+        self.last_keep_alive = time.monotonic()
+
+    def average_connect_seconds(self):
+        return self.connect_seconds / self.connects if self.connects else 0.0
+
+    def stats(self):
+        return {
+            "connected": self.is_connected(),
+            "connects": self.connects,
+            "drops": self.drops,
+            "warm_tests": self.warm_tests,
+            "cold_tests": self.cold_tests,
+            "avg_connect_ms": self.average_connect_seconds() * 1000,
+            "connect_ms_saved": self.warm_tests * self.average_connect_seconds() * 1000,
+        }
+
+
+class PooledBreathalyzer:
+    """One device in the pool: its BacTrack, the manager keeping its link warm, and who is testing on it."""
+
+    def __init__(self, label, bac_track):
+        self.label = label  # what guests are told, the device's position in BACTRACK_BLE_ADDRESSES
+        self.bac_track = bac_track
+        self.ble = BleConnectionManager(bac_track)
+        self.client_number = None  # guest testing on it, None while free
+        self.tests = 0
+
+    def is_free(self):
+        return self.client_number is None
+
+    def rank(self):
+        # lower is better: a battery we know is low last, a warm link first, then the fuller battery
+        return (
+            self.bac_track.battery.state() == "Low",
+            not self.ble.is_connected(),
+            -(self.bac_track.battery.percentage or 0),
+        )
+
+    def stats(self):
+        return {
+            "label": self.label,
+            "busy": not self.is_free(),
+            "tests": self.tests,
+            "battery": self.bac_track.battery.state(),
+            **self.ble.stats(),
+        }
+
+
+class BreathalyzerPool:
+    """Every configured breathalyzer, each with its own BLE link, handed out to one guest at a time.
+
+    All sessions run concurrently on the event loop that drives BLE, so tests on
+    different devices overlap and throughput grows with the number of devices.
+    """
+
+    def __init__(self, bac_tracks):
+        self.devices = [
+            PooledBreathalyzer(label, bac_track)
+            for label, bac_track in enumerate(bac_tracks, start=1)
+        ]
+
+    def __len__(self):
+        return len(self.devices)
+
+    async def start(self):
+        for device in self.devices:
+            await device.ble.start()
+
+    def request_connection(self):
+        for device in self.devices:
+            device.ble.request_connection()
+
+    def free_count(self):
+        return sum(device.is_free() for device in self.devices)
+
+    def acquire(self, client_number):
+        """Hand the best free device to client_number, None while every device is busy."""
+        free_devices = [device for device in self.devices if device.is_free()]
+        if not free_devices:
+            return None
+        device = min(free_devices, key=PooledBreathalyzer.rank)
+        device.client_number = client_number
+        return device
+
+    def release(self, device):
+        device.client_number = None
+        device.tests += 1
+
+    def stats(self):
+        return [device.stats() for device in self.devices]
@@ -1,41 +1,168 @@
 import logging
-import asyncio
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
-from flask import Flask, request
-from threading import Thread
+from flask import Flask, Response, request
 from twilio.twiml.messaging_response import MessagingResponse
+from async_worker import AsyncWorker
+from globals import webhook_dedup
+from log_setup import QueuedLogging
 from logic import Logic
+from metrics import Counter, Gauge, Histogram, default_registry
+from prompts import server_busy
 
 current_time = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 log_filename = f"log_{current_time}.txt"
 
 
-logging.basicConfig(
-    filename="logs/" + log_filename,
-    filemode="w",
-    format="%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s",
-    datefmt="%H:%M:%S",
-    level=logging.INFO,
+# a background thread writes the log file, nothing on the request or BLE path waits on flash
+queued_logging = QueuedLogging("logs/" + log_filename)
+
+inbound_messages = Counter(
+    "party_inbound_messages_total",
+    "SMS webhooks received, by what happened to them.",
+    ["outcome"],
+)
+handler_seconds = Histogram(
+    "party_handler_seconds", "Time to handle one inbound message on the async worker."
 )
 
 
+class MessageSidCache:
+    """MessageSids seen within the last ttl seconds, oldest first so expiry only ever looks at the front."""
+
+    def __init__(
+        self, ttl=webhook_dedup["ttl_seconds"], max_entries=webhook_dedup["max_entries"]
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.seen = OrderedDict()  # MessageSid -> time first seen
+        self.lock = threading.Lock()
+        self.dropped_duplicates = 0
+
+    def check_and_add(self, message_sid):
+        """True the first time a MessageSid shows up, False for a retry of it."""
+        now = time.monotonic()
+        with self.lock:
+            while self.seen and (
+                len(self.seen) >= self.max_entries
+                or now - next(iter(self.seen.values())) > self.ttl
+            ):
+                self.seen.popitem(last=False)
+            if message_sid in self.seen:
+                self.dropped_duplicates += 1
+                return False
+            self.seen[message_sid] = now
+            return True
+
+    def discard(self, message_sid):
+        with self.lock:
+            self.seen.pop(message_sid, None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "tracked_sids": len(self.seen),
+                "dropped_duplicates": self.dropped_duplicates,
+            }
+
+
 class FlaskApp:
     def __init__(
         self,
     ):  # the vestaboard instance should be tied to the Game instance, and should be accessed using locks
         self.app = Flask(__name__)
+        self.worker = AsyncWorker()  # one event loop for every inbound message
+        self.seen_messages = MessageSidCache()
         self.logic_instance = Logic()
+        # BLE lives on the worker loop, bring the breathalyzer link up before the first blow
+        self.worker.run_coroutine(self.logic_instance.pool.start())
         self.app.route("/sms", methods=["POST"])(self.sms_reply)
+        self.app.route("/metrics", methods=["GET"])(self.metrics)
+        self.register_metrics()
 
-    def run_async_task(self, coro):
-        """Run an async coroutine in a new event loop."""
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(coro)
-        loop.close()
+    def register_metrics(self):
+        """Metrics read from existing state at scrape time, so they cost the hot path nothing."""
+        worker, logic = self.worker, self.logic_instance
+        pool, vestaboard = logic.pool.devices, logic.vestaboard
+        Gauge(
+            "party_worker_active_handlers",
+            "Inbound messages being handled right now.",
+            function=lambda: worker.active,
+        )
+        Gauge(
+            "party_worker_queue_depth",
+            "Inbound messages waiting for a handler.",
+            function=lambda: worker.queued,
+        )
+        Gauge(
+            "party_sms_pending_messages",
+            "Outbound SMS queued or awaiting a retry.",
+            function=lambda: logic.messenger.stats()["pending_messages"],
+        )
+        Counter(
+            "party_sms_sent_total",
+            "Outbound SMS Twilio accepted.",
+            function=lambda: logic.messenger.sent_messages,
+        )
+        Counter(
+            "party_vestaboard_writes_total",
+            "Frames written to the Vestaboard.",
+            function=lambda: vestaboard.writes,
+        )
+        Counter(
+            "party_vestaboard_skipped_writes_total",
+            "Frames never written, because the board already showed them or a newer one replaced or outranked them.",
+            ["reason"],
+            function=lambda: {
+                ("unchanged",): vestaboard.skipped_writes,
+                ("superseded",): logic.display.superseded_frames,
+                ("expired",): logic.display.expired_frames,
+            },
+        )
+        Counter(
+            "party_ble_connects_total",
+            "BLE connections made to each breathalyzer.",
+            ["device"],
+            function=lambda: {(device.label,): device.ble.connects for device in pool},
+        )
+        Counter(
+            "party_ble_drops_total",
+            "Unexpected BLE disconnects of each breathalyzer.",
+            ["device"],
+            function=lambda: {(device.label,): device.ble.drops for device in pool},
+        )
+        Gauge(
+            "party_ble_connected",
+            "Whether each breathalyzer's BLE link is up.",
+            ["device"],
+            function=lambda: {
+                (device.label,): device.ble.is_connected() for device in pool
+            },
+        )
+        Gauge(
+            "party_breathalyzer_line_length",
+            "Guests waiting in line for a breathalyzer.",
+            function=lambda: len(logic.scheduler.line),
+        )
+        Counter(
+            "party_tests_completed_total",
+            "Breathalyzer tests that have finished, successfully or not.",
+            function=lambda: logic.scheduler.completed_tests,
+        )
+        Gauge(
+            "party_persistence_pending_records",
+            "Game state records waiting for the persistence writer.",
+            function=lambda: len(logic.journal.pending),
+        )
+
+    def metrics(self):
+        return Response(default_registry.render(), mimetype="text/plain; version=0.0.4")
 
     async def process_message_async(self, client_number, message):
         """Asynchronous function to process the message."""
+        start = time.perf_counter()
         try:
 
             await self.logic_instance.process_message(client_number, message)
@@ -43,26 +170,47 @@ class FlaskApp:
             logging.error(
                 f"Error processing message for {client_number}: {e}", exc_info=True
             )
+        finally:
+            handler_seconds.observe(time.perf_counter() - start)
 
     def sms_reply(self):
         """Receive incoming SMS messages."""
         client_number = request.form["From"]
         message = request.form["Body"]
+        message_sid = request.form.get("MessageSid")
 
-        # Start a thread for processing the message asynchronously
+        # Dummy Twilio response to avoid 500 error
+        resp = MessagingResponse()
+
+        # Twilio retries the webhook when we answer slowly, the retry carries the same MessageSid
+        if message_sid and not self.seen_messages.check_and_add(message_sid):
+            inbound_messages.labels("duplicate").inc()
+            logging.info(
+                f"Dropping duplicate delivery of {message_sid} from {client_number}: {self.seen_messages.stats()}"
+            )
+            resp.message()
+            return str(resp)
 
         logging.info(
-            f"Received message: {message}, from number {client_number}. Creating new thread to handle."
+            f"Received message: {message}, from number {client_number}. Queueing it for the worker."
         )
-        thread = Thread(
-            target=self.run_async_task,
-            args=(self.process_message_async(client_number, message),),
+        # keyed by sender, so each guest's messages are handled one at a time and in order
+        accepted = self.worker.submit(
+            self.process_message_async, client_number, message, key=client_number
         )
-        thread.start()
 
-        # Dummy Twilio response to avoid 500 error
-        resp = MessagingResponse()
-        resp.message()
+        if accepted:
+            inbound_messages.labels("accepted").inc()
+            resp.message()
+        else:
+            inbound_messages.labels("rejected").inc()
+            logging.warning(
+                f"Message queue full, turning away {client_number}: {self.worker.stats()}"
+            )
+            # nothing was scheduled, so a retry of this message should get through
+            if message_sid:
+                self.seen_messages.discard(message_sid)
+            resp.message(server_busy)
         return str(resp)
 
     def run(self):
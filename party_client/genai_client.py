@@ -2,6 +2,8 @@ import requests
 import json
 import logging
 from globals import genai_client
+from http_client import shared_http_client
+from log_setup import truncate
 
 
 def request_template(
@@ -52,13 +54,15 @@ class GenAI:
     def call_completions(self, payload: dict) -> tuple:
         """Calls the completion API and returns the response text and status code."""
         json_payload = json.dumps(payload)
+        status_code = None
         try:
             logging.info(
-                f"Sending completions request to {self.model_url}, with header {self.headers} and payload {json_payload}"
+                f"Sending completions request to {self.model_url}, with payload {truncate(json_payload)}"
             )
-            response = requests.post(
-                self.model_url, headers=self.headers, data=json_payload
+            response = shared_http_client.post(
+                "gemini", self.model_url, headers=self.headers, data=json_payload
             )
+            status_code = response.status_code
             logging.info(
                 f"Received response from API, with response code {response.status_code}"
             )
@@ -68,7 +72,7 @@ class GenAI:
                 "parts"
             ][0]["text"]
 
-            logging.info(f"Parsed user message: {response_text}")
+            logging.info(f"Parsed user message: {truncate(response_text)}")
             return response_text, response.status_code
 
         except requests.exceptions.HTTPError as http_err:
@@ -79,4 +83,4 @@ class GenAI:
             logging.error(f"Error decoding JSON response: {json_err}")
         except Exception as e:
             logging.error(f"An unexpected error occurred: {e}")
-        return None, response.status_code
+        return None, status_code
@@ -27,15 +27,24 @@ opt_out = "<OPT_OUT_KEYWORD>"
 
 bactrack_metadata = (
     {  # apparently BLE convention for UUID names, is all caps, minor thing
-        "BACTRACK_BLE_ADDRESS": "<BACTRACK_BLE_ADDRESS>",
+        # one per device, guests are told to use breathalyzer #1, #2, ... in this order
+        "BACTRACK_BLE_ADDRESSES": ["<BACTRACK_BLE_ADDRESS>"],
         "BATTERY_LEVEL_CHARACTERISTIC_UUID": "<BATTERY_LEVEL_UUID>",
         "CONNECTION_INITIALIZATION_UUID": "<CONNECTION_INIT_UUID>",
         "START_TEST_UUID": "<START_TEST_UUID>",
         "TEST_RESULTS_LISTENER_UUID": "<TEST_RESULTS_LISTENER_UUID>",
         "test_timeout_duration": 60,
         "connection_timeout_duration": 10,
-        "read_notifications_timeout_duration": 4,
+        # longest silence allowed in each stage before a test counts as stalled, stage 0 is before the first notification
+        "stage_timeouts_seconds": {0: 10, 1: 10, 2: 4, 3: 4, 4: 15},
         "max_conduct_test_retries": 2,
+        "keep_alive_interval_seconds": 30,  # battery read that keeps an idle link from being dropped
+        "idle_disconnect_seconds": 900,  # let the link go after this long without anyone blowing
+        "reconnect_backoff_seconds": 2,  # doubled after every failed reconnect
+        "max_reconnect_backoff_seconds": 60,
+        "battery_cache_ttl_seconds": 300,  # the keep-alive reads refresh it well within this
+        "battery_smoothing": 0.2,  # EWMA weight of the newest voltage sample
+        "battery_history_size": 240,  # smoothed samples kept for the trend
     }
 )
 
@@ -48,11 +57,28 @@ vestaboard_metadata = {
     "default_min_char_code": 0,
     "default_max_char_code": 71,
     "vbml_url": "<VBML_URL>",
+    "local_api_port": 7000,
+    "probe_timeout_seconds": 2,
+    "health_check_interval_seconds": 15,  # 0 disables the background endpoint monitor
+    # "remote" calls vbml_url; "local" is an EXPERIMENTAL in-process renderer, not yet shown to match
+    # the API. Only switch once `make vbml-golden-record` has recorded vbml_golden.json from the real
+    # API and `make test` passes against it
+    "vbml_renderer": "remote",
+    "vbml_cache_size": 128,
+    "vbml_cache_file": "vbml_cache.json",  # None to keep the cache in memory only
+    "vbml_cache_save_interval_seconds": 300,  # new frames reach the cache file at most this often
+    "seed_frame_from_board": True,  # read the board at startup so the first repeat write is skipped
+    "min_write_interval_seconds": 5,  # the flaps need a few seconds to settle per frame
 }
 
 game_state = {
     "backup_file_name": "<BACKUP_FILE_NAME>",
     "backup_edit_threshold": 4,
+    "journal_suffix": ".journal",
+    "journal_compaction_threshold": 500,
+    "flush_interval_ms": 250,
+    "state_backend": "journal",  # "journal" or "sqlite"
+    "sqlite_suffix": ".sqlite3",
 }
 
 bactrack_stats = {
@@ -75,4 +101,81 @@ bactrack_stats = {
 genai_client = {
     "google_api_key": "<GOOGLE_API_KEY>",
     "gemini_15_flash_url": "<GEMINI_FLASH_URL>",
-}
\ No newline at end of file
+}
+
+http_client = {
+    # timeout is (connect, read) seconds. retries cover connection errors for every request, read
+    # timeouts and 502/503/504 only for GETs and for POSTs on endpoints marked idempotent_post
+    "endpoints": {
+        "vestaboard": {
+            "timeout": (2, 5),
+            "retries": 1,
+            "backoff_factor": 0.2,
+            "pool_size": 2,
+        },
+        "vbml": {
+            "timeout": (3, 10),
+            "retries": 2,
+            "backoff_factor": 0.5,
+            "pool_size": 2,
+            "idempotent_post": True,  # compose only converts text, sending it twice is harmless
+        },
+        "gemini": {
+            "timeout": (3, 20),
+            "retries": 1,
+            "backoff_factor": 0.5,
+            "pool_size": 2,
+        },
+        "bactrack_stats": {
+            "timeout": (3, 10),
+            "retries": 2,
+            "backoff_factor": 0.5,
+            "pool_size": 1,
+        },
+    },
+}
+
+message_worker = {
+    "max_queue_size": 100,
+    "concurrency": 4,
+    "queue_full_policy": "reject",  # "reject" answers the guest right away, "wait" blocks the webhook briefly
+    "queue_full_wait_seconds": 2,
+    "wait_time_window": 500,  # most recent queue waits kept for the percentiles
+}
+
+outbound_messaging = {
+    # Twilio queues anything above its per-number send rate, so stay near it
+    "rate_per_second": 10,
+    "burst": 10,
+    "concurrency": 8,
+    "broadcast_history": 20,  # finished broadcasts kept around for their per-recipient status
+    "queue_file_name": "outbound_queue.journal",
+    "compaction_threshold": 500,  # delivered messages before the queue journal is rewritten
+    "max_attempts": 5,
+    "retry_backoff_seconds": 1,  # doubled after every failed attempt
+    "max_retry_backoff_seconds": 30,
+}
+
+webhook_dedup = {
+    "ttl_seconds": 600,  # Twilio's webhook retries arrive well inside this window
+    "max_entries": 5000,
+}
+
+test_scheduler = {
+    "default_test_seconds": 45,  # ETA guess until the first tests have been timed
+    "duration_window": 20,  # most recent tests averaged for the ETA
+    "wait_time_window": 500,  # most recent line waits kept for the percentiles
+    "throughput_window_seconds": 3600,
+}
+
+stage_timing = {
+    "window": 500,  # most recent samples kept per stage for the percentiles
+    "log_interval_seconds": 300,  # 0 disables the periodic dump to the log
+}
+
+logging_config = {
+    "max_queue_size": 10000,  # records waiting for the writer thread, newer ones are dropped past this
+    "max_payload_chars": 200,  # longer request/response bodies are cut in the log
+    "notification_log_interval_seconds": 1.0,  # at most one per-notification debug line this often
+    "quiet_loggers": ["twilio", "urllib3"],  # library loggers that log whole requests at INFO
+}
@@ -0,0 +1,97 @@
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from globals import http_client
+from metrics import Histogram
+
+request_seconds = Histogram(
+    "party_http_request_seconds",
+    "Latency of outgoing HTTP calls (Vestaboard, VBML, Gemini, BACtrack stats), failures included.",
+    ["endpoint"],
+)
+
+
+class HttpClient:
+    """Keep-alive sessions per endpoint, each with its own timeout and retry policy."""
+
+    def __init__(self, endpoints=http_client["endpoints"]):
+        self.endpoints = endpoints
+        self.sessions = {}  # endpoint name -> (requests.Session, HTTPAdapter)
+        self.request_counts = {}
+        self.lock = threading.Lock()
+
+    def session(self, endpoint):
+        with self.lock:
+            if endpoint not in self.sessions:
+                policy = self.endpoints[endpoint]
+                # connect errors are retried for every method, the request never left. Read
+                # timeouts and 502/503/504 only for methods that are safe to send twice: a
+                # Vestaboard write or a Gemini call may already have run on the server.
+                allowed_methods = (
+                    ("GET", "POST") if policy.get("idempotent_post") else ("GET",)
+                )
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=policy["pool_size"],
+                    max_retries=Retry(
+                        total=policy["retries"],
+                        backoff_factor=policy["backoff_factor"],
+                        status_forcelist=(502, 503, 504),
+                        allowed_methods=allowed_methods,
+                        raise_on_status=False,
+                    ),
+                )
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.sessions[endpoint] = (session, adapter)
+                self.request_counts[endpoint] = 0
+            self.request_counts[endpoint] += 1
+            return self.sessions[endpoint][0]
+
+    def request(self, endpoint, method, url, **kwargs):
+        kwargs.setdefault("timeout", tuple(self.endpoints[endpoint]["timeout"]))
+        start = time.perf_counter()
+        try:
+            return self.session(endpoint).request(method, url, **kwargs)
+        finally:
+            request_seconds.labels(endpoint).observe(time.perf_counter() - start)
+
+    def get(self, endpoint, url, **kwargs):
+        return self.request(endpoint, "GET", url, **kwargs)
+
+    def post(self, endpoint, url, **kwargs):
+        return self.request(endpoint, "POST", url, **kwargs)
+
+    def stats(self):
+        """Requests vs. new TCP/TLS connections per endpoint, everything else was a reused connection."""
+        stats = {}
+        with self.lock:
+            for endpoint, (session, adapter) in self.sessions.items():
+                pools = adapter.poolmanager.pools
+                new_connections = sum(
+                    pools[key].num_connections for key in pools.keys()
+                )
+                stats[endpoint] = {
+                    "requests": self.request_counts[endpoint],
+                    "new_connections": new_connections,
+                    "reused_connections": max(
+                        0, self.request_counts[endpoint] - new_connections
+                    ),
+                }
+        return stats
+
+    def close(self):
+        with self.lock:
+            for session, adapter in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+        logging.info("Closed shared HTTP sessions")
+
+
+shared_http_client = HttpClient()
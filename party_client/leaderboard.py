@@ -0,0 +1,77 @@
+from datetime import datetime
+from itertools import islice
+
+from sortedcontainers import SortedKeyList
+
+
+class LeaderboardEntry:
+    __slots__ = ("username", "bac", "reading_time", "milli_bac")
+
+    def __init__(self, username, bac, reading_time):
+        if isinstance(reading_time, str):
+            reading_time = datetime.fromisoformat(reading_time)
+        self.username = username
+        self.bac = bac  # reading as displayed, e.g. "0.085"
+        self.reading_time = reading_time
+        self.milli_bac = round(float(bac) * 1000)
+
+    def sort_key(self):
+        # highest BAC first, whoever reached it first wins a tie
+        return -self.milli_bac, self.reading_time
+
+    def to_list(self):
+        return [self.username, self.bac, self.reading_time.isoformat()]
+
+
+class Leaderboard:
+    """Leaders ordered by numeric BAC, with a username index so updates never scan the board."""
+
+    def __init__(self):
+        self.entries = SortedKeyList(key=LeaderboardEntry.sort_key)
+        self.index = {}  # username -> LeaderboardEntry
+
+    def upsert(self, username, bac, reading_time):
+        previous = self.index.get(username)
+        if previous is not None:
+            self.entries.remove(previous)
+        entry = LeaderboardEntry(username, bac, reading_time)
+        self.index[username] = entry
+        self.entries.add(entry)
+        return entry
+
+    def remove(self, username):
+        entry = self.index.pop(username, None)
+        if entry is not None:
+            self.entries.remove(entry)
+
+    def get(self, username):
+        return self.index.get(username)
+
+    def rank(self, username):
+        """0-based position of username on the board, -1 if they have no reading yet."""
+        entry = self.index.get(username)
+        if entry is None:
+            return -1
+        return self.entries.index(entry)
+
+    def top(self, k):
+        return list(islice(self.entries, k))
+
+    def __getitem__(self, pos):
+        return self.entries[pos]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def to_list(self):
+        return [entry.to_list() for entry in self.entries]
+
+    @classmethod
+    def from_list(cls, data):
+        leaderboard = cls()
+        for username, bac, reading_time in data:
+            leaderboard.upsert(username, bac, reading_time)
+        return leaderboard
@@ -0,0 +1,98 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import time
+
+from globals import logging_config
+
+log_format = "%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s"
+log_datefmt = "%H:%M:%S"
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread and never blocks: when the queue is full the record is dropped and counted."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped_records = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped_records += 1
+
+
+class QueuedLogging:
+    """Root logger -> bounded queue -> one background thread that owns the log file.
+
+    Request threads, the BLE callback and the workers only pay for formatting the
+    record and a queue put; the file writes and flushes happen on the listener thread.
+    """
+
+    def __init__(
+        self,
+        filename,
+        level=logging.INFO,
+        max_queue_size=logging_config["max_queue_size"],
+        quiet_loggers=logging_config["quiet_loggers"],
+    ):
+        file_handler = logging.FileHandler(filename, mode="w")
+        file_handler.setFormatter(logging.Formatter(log_format, log_datefmt))
+        log_queue = queue.Queue(maxsize=max_queue_size)
+        self.handler = DroppingQueueHandler(log_queue)
+        self.listener = logging.handlers.QueueListener(log_queue, file_handler)
+        self.is_running = True
+
+        root = logging.getLogger()
+        root.setLevel(level)
+        root.addHandler(self.handler)
+        for name in quiet_loggers:
+            logging.getLogger(name).setLevel(logging.WARNING)
+        self.listener.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Write out whatever is still queued, then stop the writer thread."""
+        if not self.is_running:
+            return
+        self.is_running = False
+        if self.handler.dropped_records:
+            logging.warning(
+                f"Dropped {self.handler.dropped_records} log records while the writer was behind"
+            )
+        self.listener.stop()
+        logging.getLogger().removeHandler(self.handler)
+
+
+class LogRateLimiter:
+    """Lets at most one log line through per interval, counting the ones it held back."""
+
+    def __init__(self, interval=logging_config["notification_log_interval_seconds"]):
+        self.interval = interval
+        self.next_allowed = 0.0
+        self.suppressed = 0
+
+    def allow(self, level=logging.DEBUG):
+        """True when a line may be logged now; check it before building the message."""
+        if not logging.getLogger().isEnabledFor(level):
+            return False
+        now = time.monotonic()
+        if now < self.next_allowed:
+            self.suppressed += 1
+            return False
+        self.next_allowed = now + self.interval
+        return True
+
+    def take_suppressed(self):
+        suppressed, self.suppressed = self.suppressed, 0
+        return suppressed
+
+
+def truncate(payload, limit=logging_config["max_payload_chars"]):
+    """payload as a string cut to limit characters, for logging request and response bodies."""
+    text = str(payload)
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}... ({len(text) - limit} more chars)"
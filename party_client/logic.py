@@ -16,20 +16,27 @@ from globals import (
     admin_info,
     bactrack_metadata,
     vestaboard_metadata,
+    game_state,
 )
 
 from user import *
+from sqlite_store import SqliteStateStore
 from prompts import *
 from twilio.rest import Client
+from log_setup import truncate
+from messaging import OutboundMessenger
 from vestaboard_client import (
-    convert_vbml_to_array,
     Message,
     SubMessage,
     SubMessageStyle,
     AbsolutePosition,
     Vestaboard,
+    VestaboardDisplay,
+    DisplayPriority,
 )
-from breathalyzer_client import BacTrack
+from breathalyzer_client import BacTrack, BreathalyzerPool
+from scheduler import GuestLeftLine, TestScheduler
+from stage_timing import stage_timings
 
 
 def exposed_marker(func):
@@ -50,9 +57,12 @@ class Logic:
             if callable(method) and getattr(method, "is_exposed", False)
         ]
 
-        self.bac_track = BacTrack(
-            # the bac track instance should be tied to the Game instance as well, and definitely be lock based access
-            device_bluetooth_address=bactrack_metadata["BACTRACK_BLE_ADDRESS"],
+        # every device keeps its link up between tests, started on the worker loop by FlaskApp
+        self.pool = BreathalyzerPool(
+            [
+                BacTrack(device_bluetooth_address=address)
+                for address in bactrack_metadata["BACTRACK_BLE_ADDRESSES"]
+            ]
         )
 
         self.vestaboard = Vestaboard(
@@ -60,10 +70,25 @@ class Logic:
             ip_address=vestaboard_metadata["ip_address_two_four_wifi"],
             ip_address_alternate=vestaboard_metadata["ip_address_five_wifi"],
         )
-
-        self.test_lock = threading.Lock()  # Thread-level lock
-
-        self.users = restore_user_states()
+        self.display = VestaboardDisplay(self.vestaboard)  # only writer of the board
+
+        # Each guest's messages run one at a time (per-number mailboxes in AsyncWorker), so message
+        # handlers never race each other on a User. The breathalyzer path is the exception: it
+        # appends readings from the event loop, outside the mailbox, and the guest may opt out
+        # mid-test, so it must look the User up with .get() and cope with it being gone. What
+        # guests share sits behind these two locks, always taken in this order and never held
+        # across an SMS, BLE or HTTP call.
+        self.users_lock = (
+            threading.Lock()
+        )  # self.users membership and the username index
+        self.leaderboard_lock = threading.Lock()  # self.users["leaders"]
+
+        state_store = (
+            SqliteStateStore()
+            if game_state["state_backend"] == "sqlite"
+            else GameStateJournal()
+        )
+        self.users = state_store.restore()
         self.admin_info = admin_info
         for username, number in self.admin_info.items():
             self.users[number] = User(
@@ -74,13 +99,32 @@ class Logic:
                 onboarded=True,
             )
 
-        # a list of the top 3 leaders, using a list of lists  [["username": "player1", "score": 150, "timestamp": datetime.now()]],
-        self.usernames = {}
+        # fold whatever was restored (and the admins) into a fresh snapshot, mutations are journaled from here on
+        self.journal = PersistenceWriter(state_store, snapshot=self.snapshot_state)
+        self.journal.compact(self.users)
+
+        # username -> phone number index, so lookups and duplicate checks never scan self.users
+        self.usernames = {
+            user.username: number
+            for number, user in self.users.items()
+            if number != "leaders" and user.username
+        }
         self.genai_client = GenAI()
 
         self.twilio = Client(
             twilio_credentials["account_sid"], twilio_credentials["auth_token"]
         )
+        # undelivered texts only go out again to guests whose game state was restored
+        self.messenger = OutboundMessenger(self.twilio, recipients=self.users)
+        # one test per device, in the order guests asked; joining the line warms up the BLE links
+        self.scheduler = TestScheduler(
+            self.conduct_test,
+            self.send_msg,
+            self.pool,
+            on_waiting=self.pool.request_connection,
+        )
+        # where a test's time goes, logged periodically and texted to admins by latency
+        stage_timings.start_reporting()
 
         logging.info(
             f"Standard user runnable functions via message: {self.exposed_func_names}"
@@ -89,8 +133,6 @@ class Logic:
             f"Admin user runnable functions via message: {self.all_func_names}"
         )
 
-        self.unique_usernames = []
-
         self.superman = None
         self.super_number = None
 
@@ -107,8 +149,8 @@ class Logic:
             logging.info(
                 f"Registered user {client_number} chose to opt-out. Deleting them from users."
             )
-            self.users.pop(client_number, None)
-            persist_users_data(self.users)
+            # flushing the removal can wait on a compaction, keep that off the event loop
+            await asyncio.to_thread(self.remove_user, client_number)
             self.send_msg(client_number, opt_out_confirmation)
             return
         # process new user, checking for password
@@ -117,7 +159,7 @@ class Logic:
                 f"Attempting to create new user for unrolled number {client_number}"
             )
             args = [client_number, message]
-            responses = self.new_user(args)
+            responses = await asyncio.to_thread(self.new_user, args)
             self.send_msg(client_number, responses)
             return
 
@@ -143,8 +185,8 @@ class Logic:
             and self.users[client_number].onboarded is False
         ):
             func = getattr(self, self.users[client_number].next_step)
-            args = [client_number, message, self.bac_track]
-            responses = func(args)
+            args = [client_number, message, self.pool]
+            responses = await asyncio.to_thread(func, args)
             self.send_msg(client_number, responses)
             return
 
@@ -152,21 +194,25 @@ class Logic:
         # user wants to run valid commands
         func = getattr(self, func_name)
         try:
-            response = await func(client_number) if func_name == "blow" else func(args)
+            # blocking command handlers go to the worker's thread pool, the event loop stays free for BLE
+            response = (
+                await func(client_number)
+                if func_name == "blow"
+                else await asyncio.to_thread(func, args)
+            )
         except Exception as e:
             self.send_msg(client_number, general_error)
         self.send_msg(client_number, response)
         return
 
-    def broadcast(self, message):
-        print("broadcasting")
-        for client_number in self.users.keys():
-            if client_number != "leaders":
-                self.send_msg(client_number, message)
+    def broadcast(self, messages):
+        """Queue messages for every guest and return right away, delivery continues in the background."""
+        with self.users_lock:
+            recipients = [number for number in self.users.keys() if number != "leaders"]
+        return self.messenger.broadcast(recipients, messages)
 
     def start_game(self, args):
-        self.broadcast(game_instruction_msg)
-        self.broadcast(accurate_results)
+        self.broadcast([game_instruction_msg, accurate_results])
         self.send_vesta_message(start_prompt)
         return broadcast_success
 
@@ -180,10 +226,22 @@ class Logic:
         return broadcast_success
 
     def find_phone_by_username(self, username):
-        for phone_number, user in self.users.items():
-            if user.username == username:
-                return phone_number
-        return None  # Return None if the username is not found
+        return self.usernames.get(username)  # None if the username is not found
+
+    def snapshot_state(self, users):
+        """Copy of users for the persistence writer to serialize without racing the handlers."""
+        with self.users_lock:
+            snapshot = dict(users)
+        with self.leaderboard_lock:
+            snapshot["leaders"] = Leaderboard.from_list(users["leaders"].to_list())
+        return snapshot
+
+    def remove_user(self, client_number):
+        with self.users_lock:
+            user = self.users.pop(client_number, None)
+            if user is not None and self.usernames.get(user.username) == client_number:
+                self.usernames.pop(user.username)
+        self.journal.record_user_removal(self.users, client_number)
 
     def new_user(self, args):
 
@@ -199,8 +257,9 @@ class Logic:
         responses.append(welcome_message)
         responses.append(username_prompt)
 
-        self.users[client_number] = User(client_number)
-        persist_users_data(self.users)
+        with self.users_lock:
+            self.users[client_number] = User(client_number)
+        self.journal.record_user(self.users, client_number)
         logging.info(f"Number {client_number} sent correct password")
 
         return responses
@@ -216,7 +275,6 @@ class Logic:
             or len(new_user_name) < 0
             or new_user_name.isalnum() is False
             or new_user_name == master_credentials["master_password"]
-            or new_user_name in self.unique_usernames  # check for duplicate usernames
         ):
             logging.error(
                 f"Received invalid username: {new_user_name} during registration",
@@ -224,11 +282,22 @@ class Logic:
             )
             return username_error
 
-        self.users[client_number].username = new_user_name
+        # check and claim the username in one step, two guests may race for the same one
+        with self.users_lock:
+            if new_user_name in self.usernames:
+                logging.error(
+                    f"Received duplicate username: {new_user_name} during registration"
+                )
+                return username_error
+            previous_user_name = self.users[client_number].username
+            if self.usernames.get(previous_user_name) == client_number:
+                self.usernames.pop(previous_user_name)
+            self.users[client_number].username = new_user_name
+            self.usernames[new_user_name] = client_number
         logging.info(f"Number {client_number} registered as {new_user_name}")
 
         self.users[client_number].next_step = "agree_to_terms"
-        persist_users_data(self.users)
+        self.journal.record_user(self.users, client_number)
 
         return [username_success, terms]
 
@@ -240,14 +309,13 @@ class Logic:
 
         if response != "1":
             logging.info("User did not consent to T&C, removing them")
-            self.users.pop(client_number, None)
-            persist_users_data(self.users)
+            self.remove_user(client_number)
             return opt_out_confirmation
 
         self.users[client_number].agreed_to_terms = True
         self.users[client_number].onboarded = True
         self.users[client_number].next_step = "gameplay"
-        persist_users_data(self.users)
+        self.journal.record_user(self.users, client_number)
 
         return onboarding_success
 
@@ -265,7 +333,7 @@ class Logic:
         phone_number = phone_numbers["backend_number"]
         formatted_number = f"{phone_number[:2]}-{phone_number[2:5]}-{phone_number[5:8]}-{phone_number[8:]}"
         msg = f"Text {password} to the phone number {formatted_number}"
-        self.send_vesta_message(msg)
+        self.send_vesta_message(msg, priority=DisplayPriority.IDLE)
 
     def reading_age(self, time_then):
         if isinstance(time_then, str):
@@ -280,14 +348,10 @@ class Logic:
         reading_age = min(rounded_minutes_ago, 99)
         return str(reading_age).zfill(2)
 
-    def get_leader(self, pos):
-        if pos >= len(self.users["leaders"]):  # there is no silver or bronze
-            return ""
-
-        leader_data = self.users["leaders"][pos]
-        username = leader_data[0]
-        bac_score = leader_data[1]
-        reading_time = leader_data[2]
+    def get_leader(self, pos, leader):
+        username = leader.username
+        bac_score = leader.bac
+        reading_time = leader.reading_time
 
         formatted_username = username.ljust(username_max_len)
         formatted_bac_score = bac_score[1:]
@@ -300,10 +364,10 @@ class Logic:
         return formatted_line
 
     def find_user_index(self, username):
-        for index, user in enumerate(self.users["leaders"]):
-            if user[0] == username:  # Check if the username matches
-                return index
-        return -1  # Return -1 if the username is not found
+        with self.leaderboard_lock:
+            return self.users["leaders"].rank(
+                username
+            )  # -1 if the username is not found
 
     def update_vesta_leaderboard(self, username, bac_score, time_now):
         # make username padded for vesta formatting
@@ -311,13 +375,15 @@ class Logic:
         formatted_username = username.ljust(username_max_len)
         formatted_bac_score = bac_score[1:]
 
-        # current users position
-        pos = self.find_user_index(username)
+        # current users position, read together with the podium so both come from the same board
+        with self.leaderboard_lock:
+            pos = self.users["leaders"].rank(username)
+            top_three = self.users["leaders"].top(3)
         line_1 = "{64}{68}{64}{68}{64}Leaderboard{64}{68}{64}{68}{64}{68}"
-        gold = self.get_leader(0)
-
-        silver = self.get_leader(1)
-        bronze = self.get_leader(2)
+        podium = [self.get_leader(pos, leader) for pos, leader in enumerate(top_three)]
+        gold, silver, bronze = podium + [""] * (
+            3 - len(podium)
+        )  # may be no silver or bronze
         line_5 = "{64}{68}{64}{68}{64}{68}{64}{68}{64}{68}{64}{68}{64}{68}{64}{68}{64}{68}{64}{68}{64}{68}"
 
         if pos == 0:
@@ -337,10 +403,12 @@ class Logic:
 
     def update_superman(self, username, client_number):
 
-        gold_data = self.users["leaders"][0]
+        with self.leaderboard_lock:
+            gold_data = self.users["leaders"][0]
+            leaders = list(self.users["leaders"])
 
         if (
-            self.superman is None or self.superman != gold_data[0]
+            self.superman is None or self.superman != gold_data.username
         ):  # superman does not exist or has changed
             self.superman = username
             self.super_number = client_number
@@ -348,10 +416,10 @@ class Logic:
             self.send_msg(self.super_number, hi_superman)
 
             usernames_in_game = "Usernames + Scores\n"
-            for record in self.users["leaders"]:
+            for record in leaders:
 
-                current_user = record[0]
-                current_bac = record[1]
+                current_user = record.username
+                current_bac = record.bac
                 usernames_in_game = (
                     usernames_in_game + "- " + current_user + " " + current_bac + "\n"
                 )
@@ -373,16 +441,16 @@ class Logic:
             "{64}{68}{64}{68}{64}{68}{64}{68}{64}{68}{64}{68}{64}{68}{64}{68}{64}{68}{64}{68}{64}{68}"
         )
 
-        vesta_msg = (
-            f"Hey @{number_to_bother}, slow down and make sure you're drinking responsibly!"
-        )
+        vesta_msg = f"Hey @{number_to_bother}, slow down and make sure you're drinking responsibly!"
 
-        self.send_vesta_message(f"{line_1}\n{vesta_msg}\n{line_6}")
+        self.send_vesta_message(
+            f"{line_1}\n{vesta_msg}\n{line_6}", priority=DisplayPriority.ALERT
+        )
         self.send_msg(
             f"Hey party goer! You've been drinking a little too much and {self.superman} has noticed. Why don't you slow down and drink some water!"
         )
 
-    def send_vesta_message(self, message):
+    def send_vesta_message(self, message, priority=DisplayPriority.NORMAL):
         status_message = Message(
             components=[
                 SubMessage(
@@ -398,12 +466,8 @@ class Logic:
             ]
         )
 
-        response_code, response = convert_vbml_to_array(status_message)
-        logging.info("Sending message to VBML API")
-
-        if 200 <= response_code < 300:
-            logging.info("Sending message to Vestaboard API")
-            response_code, response = self.vestaboard.send_msg(response)
+        logging.info(f"Queueing message for Vestaboard with priority {priority.name}")
+        self.display.show(status_message, priority)
         return ""
 
     def update_user_vestaboard_data(self, username):
@@ -418,61 +482,91 @@ class Logic:
     def update_user_leaderboard_data(self, username, new_bac_value, new_time):
         # Check if the user exists and update their data
         logging.info("Updating user leaderboard data")
-        for user in self.users["leaders"]:
-            if user[0] == username:
-                user[1] = new_bac_value  # Update bac_value
-                user[2] = new_time  # Update timestamp
-                logging.info(
-                    f"Updated {username}'s leaderboard data to {new_bac_value} and timestamp {new_time}."
-                )
-                self.users["leaders"].sort(
-                    key=lambda x: x[1], reverse=True
-                )  # sort based on descending back score
-                persist_users_data(self.users)
-                return
-
-        # If the user is not found, you can optionally add them to the list
-        self.users["leaders"].append([username, new_bac_value, new_time])
-        self.users["leaders"].sort(
-            key=lambda x: x[1], reverse=True
-        )  # sort based on descending back score
-
-        persist_users_data(self.users)
+        with self.leaderboard_lock:
+            self.users["leaders"].upsert(username, new_bac_value, new_time)
+        self.journal.record_leader(self.users, username, new_bac_value, new_time)
 
         logging.info(
-            f"Added new user {username} with bac_value {new_bac_value} and timestamp {new_time}."
+            f"Updated {username}'s leaderboard data to {new_bac_value} and timestamp {new_time}."
         )
         return
 
     @exposed_marker
     async def blow(self, client_number):
+        # the scheduler starts the test once it is this guest's turn, reply with their place in line
+        return self.scheduler.request(client_number)
+
+    async def conduct_test(self, client_number, device):
         # @retry(stop=stop_after_attempt(bactrack_metadata["max_conduct_test_retries"]), wait=wait_fixed(2),
         #        before=self.before_blow_retry, after=self.after_blow_retry)
-        async def conduct_test(**kwargs):
+        if client_number not in self.users:
+            raise GuestLeftLine(f"{client_number} opted out while waiting in line")
+        if len(self.pool) > 1:
+            self.send_msg(
+                client_number,
+                [use_device.format(device=device.label), blow_instructions],
+            )
+        else:
             self.send_msg(client_number, blow_instructions)
-            try:
-                await self.bac_track.bluetooth_connect()
-                reading = await self.bac_track.conduct_test(
+        try:
+            with stage_timings.span("ble_connect"):
+                await device.ble.ensure_connected()
+            with stage_timings.span("test"):
+                reading = await device.bac_track.conduct_test(
                     self.message_callback, client_number
                 )
-            except Exception as e:
-                raise Exception(f"Unhandled error during BAC test: {str(e)}")
-            finally:
-                await self.bac_track.bluetooth_disconnect()
-            # self.post_test_vestaboard_display(client_number)
-            username = (self.users[client_number]).username
-            time_now = datetime.now()
+        except Exception as e:
+            self.send_msg(client_number, general_error)
+            raise Exception(f"Unhandled error during BAC test: {str(e)}")
+        # the link stays up for the next guest
+        logging.info(f"Breathalyzer #{device.label} link stats: {device.ble.stats()}")
+        # self.post_test_vestaboard_display(client_number)
+        user = self.users.get(client_number)
+        if user is None:
+            logging.info(f"{client_number} opted out during their test, not ranking it")
+            return
+        username = user.username
+        time_now = datetime.now()
+        with stage_timings.span("leaderboard_update"):
             self.update_user_leaderboard_data(username, reading, time_now)
-            # self.update_user_vestaboard_data(username) # COMMENT OUT
-            # sleep(10) # COMMENT OUT
-            self.update_vesta_leaderboard(username, reading, time_now)
-            # self.update_superman(username, client_number)
-
-        if not self.test_lock.locked():
-            with self.test_lock:
-                await conduct_test(client_number=client_number)
-        else:
-            self.send_msg(client_number, wait_to_blow)
+        # self.update_user_vestaboard_data(username) # COMMENT OUT
+        # sleep(10) # COMMENT OUT
+        self.update_vesta_leaderboard(username, reading, time_now)
+        # self.update_superman(username, client_number)
+
+    def battery(self, args):
+        lines = []
+        for device in self.pool.devices:
+            stats = device.bac_track.battery.stats()
+            if stats["smoothed_voltage"] is None:
+                lines.append(
+                    f"#{device.label}: no battery reading yet, is it connected?"
+                )
+                continue
+            trend = stats["volts_per_hour"]
+            remaining = stats["estimated_remaining_tests"]
+            lines.append(
+                f"#{device.label}: {stats['state']} at {stats['percentage']}% "
+                f"({stats['smoothed_voltage']:.2f} V smoothed), "
+                f"trend {'n/a' if trend is None else f'{trend:+.2f} V/h'}, "
+                f"~{'?' if remaining is None else remaining} tests left"
+            )
+        return "ADMIN: Battery\n" + "\n".join(lines)
+
+    def latency(self, args):
+        summary = stage_timings.summary()
+        if not summary:
+            return "ADMIN: No stage timings yet, nobody has blown."
+        return f"ADMIN: Stage latency p50/p95/p99\n{summary}"
+
+    def blow_queue(self, args):
+        stats = self.scheduler.stats()
+        return (
+            f"ADMIN: {stats['in_line']} in line, {stats['testing']}/{stats['devices']} devices testing, "
+            f"{stats['completed_tests']} tests done, "
+            f"{stats['tests_per_hour']:.1f} tests/hour, avg test {stats['avg_test_s']:.0f}s, "
+            f"wait p50 {stats['wait_p50_s']:.0f}s / p95 {stats['wait_p95_s']:.0f}s"
+        )
 
     def send_msg(self, client_number, responses):
         if not responses:
@@ -483,12 +577,9 @@ class Logic:
             responses = [responses]
         for response in responses:  # multiple responses
             logging.info(
-                f"Sending message to {client_number}, with value {str(response)}"
+                f"Queueing message to {client_number}, with value {truncate(response)}"
             )
-            message = self.twilio.messages.create(
-                to=client_number, from_=phone_numbers["backend_number"], body=response
-            )
-            logging.info(message)
+            self.messenger.enqueue(client_number, response)
         return
 
     # @retry(stop=stop_after_attempt(2), wait=wait_fixed(2))
@@ -500,9 +591,14 @@ class Logic:
                 self.send_msg(client_number, blow_complete)
             elif description == "ATTAINED_RESULTS":
                 # self.send_msg(client_number, blow_results.format(countdown)) # countdown here is the results
-                current_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                self.users[client_number].test_history[countdown] = current_timestamp
-                persist_users_data(self.users)
+                user = self.users.get(client_number)
+                if user is None:
+                    return  # opted out mid-test, their data is already gone
+                current_timestamp = datetime.now().timestamp()
+                user.test_history.append(countdown, current_timestamp)
+                self.journal.record_test(
+                    self.users, client_number, countdown, current_timestamp
+                )
 
         except Exception as e:
             logging.error(f"Exception in bac_track listener callback {e}")
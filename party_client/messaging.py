@@ -0,0 +1,414 @@
+import atexit
+import functools
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from twilio.base.exceptions import TwilioRestException
+
+from globals import game_state, outbound_messaging, phone_numbers
+from metrics import Counter, Histogram
+
+send_seconds = Histogram(
+    "party_sms_send_seconds", "Latency of one Twilio messages.create call."
+)
+send_failures = Counter(
+    "party_sms_failures_total",
+    "Failed Twilio sends, retryable ones are tried again.",
+    ["retryable"],
+)
+
+
+class TokenBucket:
+    """Thread-safe token bucket, acquire() blocks until a token is available."""
+
+    def __init__(self, rate_per_second, burst):
+        self.rate = rate_per_second
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated_at) * self.rate
+                )
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Broadcast:
+    """Per-recipient delivery status of messages fanned out to many recipients."""
+
+    def __init__(self, broadcast_id, bodies, recipients):
+        self.broadcast_id = broadcast_id
+        self.bodies = bodies
+        self.statuses = {number: "queued" for number in recipients}
+        self.remaining = len(self.statuses)
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        if not self.remaining:
+            self.finish()
+
+    def record(self, number, status):
+        """Store a recipient's final status, True for the call that completes the broadcast."""
+        with self.lock:
+            if self.statuses[number] != "queued":
+                return False
+            self.statuses[number] = status
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.finish()
+                return True
+            return False
+
+    def finish(self):
+        self.finished_at = time.monotonic()
+        self.finished.set()
+
+    def wait(self, timeout=None):
+        return self.finished.wait(timeout)
+
+    def summary(self):
+        with self.lock:
+            counts = {}
+            for status in self.statuses.values():
+                key = "failed" if status.startswith("failed") else status
+                counts[key] = counts.get(key, 0) + 1
+        elapsed = (self.finished_at or time.monotonic()) - self.started_at
+        return {"broadcast_id": self.broadcast_id, "elapsed_s": elapsed, **counts}
+
+
+class OutboundMessage:
+    __slots__ = ("message_id", "to", "body", "enqueued_at", "attempts", "on_done")
+
+    def __init__(self, message_id, to, body, enqueued_at, on_done=None):
+        self.message_id = message_id
+        self.to = to
+        self.body = body
+        self.enqueued_at = (
+            enqueued_at  # epoch seconds, so a restart can tell stale messages
+        )
+        self.attempts = 0
+        self.on_done = on_done  # called with the final status, not persisted
+
+    def to_record(self):
+        return {
+            "op": "enqueue",
+            "id": self.message_id,
+            "to": self.to,
+            "body": self.body,
+            "enqueued_at": self.enqueued_at,
+        }
+
+
+class OutboundQueue:
+    """Undelivered messages as one FIFO per recipient, journaled so a restart resends whatever was still pending.
+
+    Delivery is at-least-once: a crash between Twilio accepting a message and its
+    "done" record reaching the journal sends that message again after the restart.
+    Messages older than the game state backup_edit_threshold, or to numbers that are
+    not in recipients, belong to a previous party and are dropped instead.
+    """
+
+    def __init__(
+        self,
+        backup_dir=None,
+        compaction_threshold=outbound_messaging["compaction_threshold"],
+        recipients=None,
+        max_age_hours=game_state["backup_edit_threshold"],
+    ):
+        self.backup_dir = backup_dir or os.getcwd()
+        self.queue_file = os.path.join(
+            self.backup_dir, outbound_messaging["queue_file_name"]
+        )
+        self.compaction_threshold = compaction_threshold
+        self.pending = {}  # recipient -> deque of OutboundMessage, head is next to send
+        self.finished_since_compaction = 0
+        self.journal = None
+        self.restore(recipients, max_age_hours)
+
+    def restore(self, recipients=None, max_age_hours=None):
+        """Reload undelivered messages; recipients (e.g. the restored users) limits who still gets theirs."""
+        messages = {}
+        stale = 0
+        oldest_allowed = (
+            time.time() - max_age_hours * 3600 if max_age_hours is not None else None
+        )
+        if os.path.isfile(self.queue_file):
+            with open(self.queue_file, "r") as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # a crash mid-append can only tear the final record
+                        logging.warning("Dropping torn record at end of outbound queue")
+                        break
+                    if record["op"] == "enqueue":
+                        messages[record["id"]] = OutboundMessage(
+                            record["id"],
+                            record["to"],
+                            record["body"],
+                            record.get("enqueued_at", 0),  # unknown age counts as stale
+                        )
+                    else:
+                        messages.pop(record["id"], None)
+        for message_id, message in list(messages.items()):
+            if (
+                oldest_allowed is not None and message.enqueued_at < oldest_allowed
+            ) or (recipients is not None and message.to not in recipients):
+                del messages[message_id]
+                stale += 1
+        # ids are handed out in enqueue order, so this restores each recipient's order too
+        for message_id in sorted(messages):
+            message = messages[message_id]
+            self.pending.setdefault(message.to, deque()).append(message)
+        self.message_ids = itertools.count(max(messages, default=0) + 1)
+        if messages:
+            logging.info(
+                f"Restored {len(messages)} undelivered messages for {len(self.pending)} recipients"
+            )
+        if stale:
+            logging.info(f"Dropped {stale} undelivered messages from a previous party")
+            self.compact()  # so the next restart does not have to skip them again
+
+    def write(self, record):
+        if not os.path.isdir(self.backup_dir):
+            return
+        if self.journal is None:
+            self.journal = open(self.queue_file, "a")
+        self.journal.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self.journal.flush()
+
+    def append(self, to, body, on_done=None):
+        message = OutboundMessage(
+            next(self.message_ids), to, body, time.time(), on_done
+        )
+        self.write(message.to_record())
+        self.pending.setdefault(to, deque()).append(message)
+        return message
+
+    def finish(self, message):
+        """Drop the recipient's head message once it was delivered or given up on."""
+        queue = self.pending[message.to]
+        queue.popleft()
+        if not queue:
+            del self.pending[message.to]
+        self.write({"op": "done", "id": message.message_id})
+        self.finished_since_compaction += 1
+        if self.finished_since_compaction >= self.compaction_threshold:
+            self.compact()
+
+    def compact(self):
+        if not os.path.isdir(self.backup_dir):
+            return
+        if self.journal is not None:
+            self.journal.close()
+        temp_file = self.queue_file + ".tmp"
+        with open(temp_file, "w") as journal:
+            for queue in self.pending.values():
+                for message in queue:
+                    journal.write(
+                        json.dumps(message.to_record(), separators=(",", ":")) + "\n"
+                    )
+        os.replace(temp_file, self.queue_file)
+        self.journal = open(self.queue_file, "a")
+        self.finished_since_compaction = 0
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.pending.values())
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+
+class OutboundMessenger:
+    """Delivers queued SMS through Twilio from a few worker threads, under a shared rate limit.
+
+    Messages to one recipient go out strictly in order, a failed head message is
+    retried with exponential backoff before anything behind it is sent, while
+    different recipients are served concurrently.
+    """
+
+    def __init__(
+        self,
+        twilio,
+        from_number=phone_numbers["backend_number"],
+        rate_per_second=outbound_messaging["rate_per_second"],
+        burst=outbound_messaging["burst"],
+        concurrency=outbound_messaging["concurrency"],
+        backup_dir=None,
+        recipients=None,
+    ):
+        self.twilio = twilio
+        self.from_number = from_number
+        self.bucket = TokenBucket(rate_per_second, burst)
+        self.queue = OutboundQueue(backup_dir, recipients=recipients)
+        self.broadcast_ids = itertools.count(1)
+        self.broadcasts = {}  # broadcast id -> Broadcast, most recent few only
+
+        self.condition = threading.Condition()
+        # (ready at, tiebreak, recipient) for recipients with a head message nobody is sending
+        self.ready = []
+        self.ready_order = itertools.count()
+        self.sent_messages = 0
+        self.retried_messages = 0
+        self.failed_messages = 0
+        self.is_running = True
+
+        now = time.monotonic()
+        self.ready = [
+            (now, next(self.ready_order), number) for number in self.queue.pending
+        ]
+        self.threads = [
+            threading.Thread(target=self.run, name=f"sms-{i}", daemon=True)
+            for i in range(concurrency)
+        ]
+        for thread in self.threads:
+            thread.start()
+        atexit.register(self.close)
+
+    def schedule(self, number, ready_at):
+        heapq.heappush(self.ready, (ready_at, next(self.ready_order), number))
+        self.condition.notify()
+
+    def enqueue(self, to, body, on_done=None):
+        """Queue one message and return right away, on_done(status) runs once it is sent or abandoned."""
+        with self.condition:
+            # a recipient with pending messages is already scheduled or being sent to
+            is_idle = to not in self.queue.pending
+            message = self.queue.append(to, body, on_done)
+            if is_idle:
+                self.schedule(to, time.monotonic())
+        return message
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.is_running:
+                    now = time.monotonic()
+                    if self.ready and self.ready[0][0] <= now:
+                        break
+                    self.condition.wait(self.ready[0][0] - now if self.ready else None)
+                if not self.is_running:
+                    return
+                number = heapq.heappop(self.ready)[2]
+                message = self.queue.pending[number][0]
+
+            status, retryable = self.send(message)
+
+            with self.condition:
+                message.attempts += 1
+                now = time.monotonic()
+                if retryable and message.attempts < outbound_messaging["max_attempts"]:
+                    self.retried_messages += 1
+                    backoff = min(
+                        outbound_messaging["max_retry_backoff_seconds"],
+                        outbound_messaging["retry_backoff_seconds"]
+                        * 2 ** (message.attempts - 1),
+                    )
+                    logging.warning(
+                        f"Retrying message {message.message_id} to {number} in {backoff}s ({status})"
+                    )
+                    self.schedule(number, now + backoff)
+                    continue
+                if status == "sent":
+                    self.sent_messages += 1
+                else:
+                    self.failed_messages += 1
+                self.queue.finish(message)
+                if number in self.queue.pending:
+                    self.schedule(number, now)
+            if message.on_done is not None:
+                message.on_done(status)
+
+    def send(self, message):
+        """One Twilio call under the rate limit, returns (status, whether a retry could help)."""
+        self.bucket.acquire()
+        start = time.perf_counter()
+        try:
+            sent = self.twilio.messages.create(
+                to=message.to, from_=self.from_number, body=message.body
+            )
+        except TwilioRestException as e:
+            logging.error(f"Twilio rejected message to {message.to}: {e}")
+            # bad numbers, opted-out recipients and the like will not succeed on retry
+            retryable = e.status == 429 or e.status >= 500
+            send_failures.labels(str(retryable).lower()).inc()
+            return f"failed: {e.status}", retryable
+        except Exception as e:
+            logging.error(f"Failed to send message to {message.to}: {e}")
+            send_failures.labels("true").inc()
+            return f"failed: {e}", True
+        finally:
+            send_seconds.observe(time.perf_counter() - start)
+        logging.info(f"Sent message {sent.sid} to {message.to}")
+        return "sent", False
+
+    def broadcast(self, recipients, bodies):
+        """Queue bodies for every recipient and return the Broadcast to poll or wait on.
+
+        Each recipient gets the bodies in order; recipients are served concurrently.
+        """
+        if isinstance(bodies, str):
+            bodies = [bodies]
+        broadcast = Broadcast(next(self.broadcast_ids), bodies, recipients)
+        self.broadcasts[broadcast.broadcast_id] = broadcast
+        while len(self.broadcasts) > outbound_messaging["broadcast_history"]:
+            self.broadcasts.pop(next(iter(self.broadcasts)))
+        for number in broadcast.statuses:
+            for i, body in enumerate(bodies):
+                self.enqueue(
+                    number,
+                    body,
+                    functools.partial(
+                        self.broadcast_progress, broadcast, number, i == len(bodies) - 1
+                    ),
+                )
+        logging.info(
+            f"Broadcast {broadcast.broadcast_id} queued for {len(broadcast.statuses)} recipients"
+        )
+        return broadcast
+
+    def broadcast_progress(self, broadcast, number, is_last, status):
+        # a recipient's status is final after their last message, or their first failure
+        if (is_last or status != "sent") and broadcast.record(number, status):
+            logging.info(f"Broadcast finished: {broadcast.summary()}")
+
+    def stats(self):
+        with self.condition:
+            return {
+                "pending_messages": len(self.queue),
+                "pending_recipients": len(self.queue.pending),
+                "sent_messages": self.sent_messages,
+                "retried_messages": self.retried_messages,
+                "failed_messages": self.failed_messages,
+            }
+
+    def close(self):
+        """Stop the workers, anything still queued stays in the journal for the next start."""
+        with self.condition:
+            if not self.is_running:
+                return
+            self.is_running = False
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join(timeout=5)
+        with self.condition:
+            self.queue.close()
@@ -0,0 +1,210 @@
+import bisect
+import os
+import resource
+import threading
+
+# seconds, from a cached VBML render up to a whole breathalyzer test
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class CounterValue:
+    __slots__ = ("lock", "value")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class GaugeValue(CounterValue):
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value  # a single store, no read-modify-write to protect
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+class HistogramValue:
+    __slots__ = ("lock", "buckets", "counts", "sum")
+
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            yield f"{name}_bucket", labels + (("le", format_value(bound)),), cumulative
+        yield f"{name}_sum", labels, total
+        yield f"{name}_count", labels, cumulative
+
+
+class Metric:
+    """One metric family, with a child per combination of label values.
+
+    Every child has its own lock, so an update is a dict lookup plus one
+    uncontended lock; nothing is shared across metrics. With function set, the
+    values are instead read at scrape time and the hot path pays nothing.
+    """
+
+    kind = None
+
+    def __init__(
+        self, name, documentation, labelnames=(), function=None, registry=None
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # function() returns a value, or {label values tuple: value} for labelled metrics
+        self.function = function
+        self.children = {}  # label values tuple -> value object
+        self.lock = threading.Lock()
+        if not self.labelnames and function is None:
+            self.labels()  # scrapes show a zero rather than nothing before the first update
+        (registry or default_registry).register(self)
+
+    def new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    def samples(self):
+        if self.function is not None:
+            values = self.function()
+            if not self.labelnames:
+                values = {(): values}
+            for label_values, value in values.items():
+                if value is not None:
+                    yield self.name, tuple(zip(self.labelnames, label_values)), value
+            return
+        for label_values, child in list(self.children.items()):
+            yield from child.samples(
+                self.name, tuple(zip(self.labelnames, label_values))
+            )
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def new_child(self):
+        return CounterValue()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def new_child(self):
+        return GaugeValue()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self, name, documentation, labelnames=(), buckets=default_buckets, registry=None
+    ):
+        self.buckets = tuple(
+            buckets
+        )  # set first, the unlabelled child is built in __init__
+        super().__init__(name, documentation, labelnames, registry=registry)
+
+    def new_child(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}  # name -> Metric
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            # FlaskApp re-registers its scrape-time metrics when it is built again, newest wins
+            self.metrics[metric.name] = metric
+
+    def render(self):
+        """Everything in the Prometheus text exposition format (version 0.0.4)."""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                if labels:
+                    rendered = ",".join(
+                        f'{key}="{escape_label(str(label))}"' for key, label in labels
+                    )
+                    lines.append(f"{name}{{{rendered}}} {format_value(value)}")
+                else:
+                    lines.append(f"{name} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def process_rss_bytes():
+    """Current resident set size, from /proc on Linux, else the peak getrusage reports."""
+    try:
+        with open("/proc/self/statm", "r") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+default_registry = MetricsRegistry()
+
+Gauge(
+    "process_resident_memory_bytes",
+    "Resident memory size in bytes.",
+    function=process_rss_bytes,
+)
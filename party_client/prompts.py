@@ -22,6 +22,8 @@ username_success = "Your username has been successfully registered."
 
 general_error = "⚠️ An unexpected error occurred. Please try again."
 
+server_busy = "⏳ We're handling a lot of messages right now. Please text again in a minute."
+
 invalid_command = "❌ Invalid command. Please try again."
 
 wrong_password = " 🔒 Invalid password. Please try again."
@@ -43,7 +45,13 @@ By continuing, you agree to these terms. Please respond with a number:
 2: I do not agree
 """
 
-wait_to_blow = "The breathalyzer is currently in use. Please text 'blow' again once the device becomes available."
+joined_line = "Every breathalyzer is in use. You're #{position} in line, {eta} until your turn. No need to text 'blow' again, we'll start your test when it's your turn."
+
+already_in_line = "You're already in line for the breathalyzer: #{position}, {eta} to go."
+
+up_next = "You're up next on the breathalyzer! Head to the testing area now."
+
+use_device = "Your test is on breathalyzer #{device}."
 
 your_turn_message = (
     "It's your turn! Head to the testing area and follow the instructions to complete your BAC test."
@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+
+from async_worker import percentile
+from globals import test_scheduler
+from stage_timing import stage_timings
+from prompts import already_in_line, joined_line, up_next
+
+
+class GuestLeftLine(Exception):
+    """Raised by run_test when the guest opted out while waiting, so no test was taken."""
+
+
+class TestScheduler:
+    """First come, first served line for the breathalyzers, run as a task on the event loop that drives BLE.
+
+    A guest is in line at most once. The guest at the front starts on whichever
+    device of the pool frees up first, tests on different devices run side by
+    side, and whoever moves to the front gets a heads-up text so they are already
+    at the testing area when their turn comes.
+    """
+
+    def __init__(self, run_test, notify, pool, on_waiting=None):
+        self.run_test = (
+            run_test  # async run_test(client_number, device), conducts one test
+        )
+        self.notify = notify  # notify(client_number, text), sends an SMS
+        self.pool = pool  # BreathalyzerPool
+        self.on_waiting = on_waiting  # called whenever someone joins the line
+        self.line = OrderedDict()  # client_number -> time they joined, front first
+        self.testing = {}  # client_number -> (device, time their test started)
+        self.tests = set()  # running test tasks, referenced so they are not collected
+        self.heads_up_sent_to = None
+        self.task = None
+        self.wake = None  # asyncio.Event, created on the loop
+
+        self.test_durations = deque(
+            [test_scheduler["default_test_seconds"]],
+            maxlen=test_scheduler["duration_window"],
+        )
+        self.wait_times = deque(maxlen=test_scheduler["wait_time_window"])
+        self.completed_at = deque()  # completion times within the throughput window
+        self.started_at = time.monotonic()
+        self.completed_tests = 0
+        self.deduplicated_requests = 0
+        self.abandoned_turns = 0  # guests who left before their turn came up
+
+    def request(self, client_number):
+        """Put a guest in line, returns the text to send them ("" when their test starts right away)."""
+        if self.task is None:
+            self.wake = asyncio.Event()
+            self.task = asyncio.create_task(self.run())
+
+        if client_number in self.testing or client_number in self.line:
+            self.deduplicated_requests += 1
+            position = self.position(client_number)
+            if position == 0:
+                return ""  # their test is already starting
+            return already_in_line.format(
+                position=position, eta=format_eta(self.eta(position))
+            )
+
+        self.line[client_number] = time.monotonic()
+        self.wake.set()
+        if self.on_waiting is not None:
+            self.on_waiting()
+        position = self.position(client_number)
+        if position == 0:
+            return ""
+        logging.info(f"{client_number} joined the breathalyzer line at #{position}")
+        return joined_line.format(position=position, eta=format_eta(self.eta(position)))
+
+    def position(self, client_number):
+        """How many devices must free up before this guest's test, so 0 means it is running or starting now."""
+        if client_number in self.testing:
+            return 0
+        free_devices = self.pool.free_count()
+        for index, number in enumerate(self.line):
+            if number == client_number:
+                return max(0, index + 1 - free_devices)
+        return None
+
+    def average_test_seconds(self):
+        return sum(self.test_durations) / len(self.test_durations)
+
+    def eta(self, position):
+        """Seconds until the guest at position starts, from the rolling average test duration.
+
+        Every test is assumed to take the average, including the ones about to
+        start on free devices, so the guest waits for the position-th device to
+        finish, plus a full test per device for every lap of the pool before that.
+        """
+        average = self.average_test_seconds()
+        now = time.monotonic()
+        finishes = sorted(
+            [
+                max(0.0, average - (now - started_at))
+                for _, started_at in self.testing.values()
+            ]
+            + [average] * (len(self.pool) - len(self.testing))
+        )
+        if position == 0 or not finishes:
+            return position * average
+        laps, slot = divmod(position - 1, len(finishes))
+        return finishes[slot] + laps * average
+
+    async def run(self):
+        while True:
+            self.dispatch()
+            # request() and every finished test wake the loop, nothing can set it between here and the wait
+            self.wake.clear()
+            await self.wake.wait()
+
+    def dispatch(self):
+        """Start a test for the front of the line on every free device."""
+        while self.line:
+            client_number = next(iter(self.line))
+            device = self.pool.acquire(client_number)
+            if device is None:
+                break
+            joined_at = self.line.pop(client_number)
+            started_at = time.monotonic()
+            self.testing[client_number] = (device, started_at)
+            self.wait_times.append(started_at - joined_at)
+            stage_timings.record("line_wait", started_at - joined_at)
+            test = asyncio.create_task(self.test(client_number, device, started_at))
+            self.tests.add(test)
+            test.add_done_callback(self.tests.discard)
+
+        if self.line and next(iter(self.line)) != self.heads_up_sent_to:
+            self.heads_up_sent_to = next(iter(self.line))
+            self.notify(self.heads_up_sent_to, up_next)
+
+    async def test(self, client_number, device, started_at):
+        try:
+            await self.run_test(client_number, device)
+        except asyncio.CancelledError:
+            raise
+        except GuestLeftLine as e:
+            # nobody blew, counting it would drag the ETA average down and inflate tests/hour
+            logging.info(f"Skipping breathalyzer turn: {e}")
+            self.abandoned_turns += 1
+            completed = False
+        except Exception as e:
+            logging.error(
+                f"Breathalyzer test for {client_number} on #{device.label} failed: {e}"
+            )
+            completed = True
+        else:
+            self.test_durations.append(time.monotonic() - started_at)
+            completed = True
+        finally:
+            del self.testing[client_number]
+            self.pool.release(device)
+            self.wake.set()
+        if completed:
+            self.record_completion()
+        logging.info(f"Breathalyzer line stats: {self.stats()}")
+
+    def record_completion(self):
+        now = time.monotonic()
+        self.completed_tests += 1
+        self.completed_at.append(now)
+        while now - self.completed_at[0] > test_scheduler["throughput_window_seconds"]:
+            self.completed_at.popleft()
+
+    def tests_per_hour(self):
+        window = min(
+            test_scheduler["throughput_window_seconds"],
+            time.monotonic() - self.started_at,
+        )
+        return len(self.completed_at) * 3600 / window if window > 0 else 0.0
+
+    def stats(self):
+        wait_times = sorted(self.wait_times)
+        return {
+            "in_line": len(self.line),
+            "testing": len(self.testing),
+            "devices": len(self.pool),
+            "completed_tests": self.completed_tests,
+            "deduplicated_requests": self.deduplicated_requests,
+            "abandoned_turns": self.abandoned_turns,
+            "tests_per_hour": self.tests_per_hour(),
+            "avg_test_s": self.average_test_seconds(),
+            "wait_p50_s": percentile(wait_times, 50),
+            "wait_p95_s": percentile(wait_times, 95),
+            "wait_max_s": wait_times[-1] if wait_times else 0.0,
+        }
+
+
+def format_eta(seconds):
+    minutes = round(seconds / 60)
+    if minutes < 1:
+        return "under a minute"
+    return f"about {minutes} min"
@@ -0,0 +1,182 @@
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+from globals import game_state
+from leaderboard import Leaderboard
+from user import StateRecorder, User
+
+schema = """
+CREATE TABLE IF NOT EXISTS users (
+    number TEXT PRIMARY KEY,
+    username TEXT,
+    next_step TEXT NOT NULL,
+    agreed_to_terms INTEGER NOT NULL,
+    onboarded INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_username ON users (username);
+
+CREATE TABLE IF NOT EXISTS tests (
+    id INTEGER PRIMARY KEY,
+    number TEXT NOT NULL,
+    milli_bac INTEGER NOT NULL,
+    taken_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tests_number ON tests (number);
+
+CREATE TABLE IF NOT EXISTS leaderboard (
+    username TEXT PRIMARY KEY,
+    bac REAL NOT NULL,
+    reading_time TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS leaderboard_bac ON leaderboard (bac DESC, reading_time);
+"""
+
+
+class SqliteStateStore(StateRecorder):
+    """Game state kept in an indexed SQLite database (WAL mode) instead of a JSON snapshot."""
+
+    def __init__(self, backup_dir=None):
+        super().__init__()
+        self.backup_dir = backup_dir or os.getcwd()
+        self.db_file = os.path.join(
+            self.backup_dir,
+            game_state["backup_file_name"] + game_state["sqlite_suffix"],
+        )
+        # only ever driven by one thread at a time, the persistence writer serializes access
+        self.connection = sqlite3.connect(self.db_file, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(schema)
+
+    def append_many(self, users, records):
+        with self.connection:
+            for record in records:
+                self.apply_record(record)
+
+    def apply_record(self, record):
+        op = record.get("op")
+        if op == "user":
+            self.upsert_user(record["user"])
+        elif op == "remove_user":
+            self.connection.execute(
+                "DELETE FROM users WHERE number = ?", (record["number"],)
+            )
+            self.connection.execute(
+                "DELETE FROM tests WHERE number = ?", (record["number"],)
+            )
+        elif op == "leader":
+            self.upsert_leader(record["username"], record["bac"], record["time"])
+        elif op == "test":
+            self.connection.execute(
+                "INSERT INTO tests (number, milli_bac, taken_at) VALUES (?, ?, ?)",
+                (
+                    record["number"],
+                    round(float(record["reading"]) * 1000),
+                    record["timestamp"],
+                ),
+            )
+        else:
+            logging.warning(f"Skipping unknown state record: {record}")
+
+    def upsert_user(self, user):
+        self.connection.execute(
+            "INSERT INTO users (number, username, next_step, agreed_to_terms, onboarded) "
+            "VALUES (?, ?, ?, ?, ?) ON CONFLICT (number) DO UPDATE SET "
+            "username = excluded.username, next_step = excluded.next_step, "
+            "agreed_to_terms = excluded.agreed_to_terms, onboarded = excluded.onboarded",
+            (
+                user["number"],
+                user["username"],
+                user["next_step"],
+                int(user["agreed_to_terms"]),
+                int(user["onboarded"]),
+            ),
+        )
+
+    def upsert_leader(self, username, bac_value, reading_time):
+        if isinstance(reading_time, datetime):
+            reading_time = reading_time.isoformat()
+        self.connection.execute(
+            "INSERT INTO leaderboard (username, bac, reading_time) VALUES (?, ?, ?) "
+            "ON CONFLICT (username) DO UPDATE SET "
+            "bac = excluded.bac, reading_time = excluded.reading_time",
+            (username, float(bac_value), reading_time),
+        )
+
+    def compact(self, users):
+        logging.info("Rewriting SQLite game state from in-memory users")
+        with self.connection:
+            self.connection.execute("DELETE FROM users")
+            self.connection.execute("DELETE FROM tests")
+            self.connection.execute("DELETE FROM leaderboard")
+            for key, value in list(users.items()):
+                if key == "leaders":
+                    for entry in value:
+                        self.upsert_leader(
+                            entry.username, entry.bac, entry.reading_time
+                        )
+                    continue
+                self.upsert_user(value.to_dict())
+                history = value.test_history
+                self.connection.executemany(
+                    "INSERT INTO tests (number, milli_bac, taken_at) VALUES (?, ?, ?)",
+                    [
+                        (key, milli_bac, taken_at)
+                        for taken_at, milli_bac in zip(
+                            history.taken_at, history.milli_bac
+                        )
+                    ],
+                )
+        self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def last_modified(self):
+        modified_times = [
+            os.path.getmtime(path)
+            for path in (self.db_file, self.db_file + "-wal")
+            if os.path.isfile(path)
+        ]
+        return max(modified_times) if modified_times else 0
+
+    def restore(self):
+        # Check if the state was modified within the allowed threshold (in hours)
+        if (time.time() - self.last_modified()) / 3600 > game_state[
+            "backup_edit_threshold"
+        ]:
+            logging.info(
+                f"SQLite state '{self.db_file}' is older than the threshold. Defaulting to empty users list."
+            )
+            return {"leaders": Leaderboard()}
+
+        logging.info(f"Restoring state of Users in game from database: {self.db_file}")
+        users = {
+            "leaders": Leaderboard.from_list(
+                (username, f"{bac:.3f}", reading_time)
+                for username, bac, reading_time in self.connection.execute(
+                    "SELECT username, bac, reading_time FROM leaderboard"
+                )
+            )
+        }
+        for number, username, next_step, agreed, onboarded in self.connection.execute(
+            "SELECT number, username, next_step, agreed_to_terms, onboarded FROM users"
+        ):
+            users[number] = User(
+                number=number,
+                username=username,
+                next_step=next_step,
+                agree_to_terms=bool(agreed),
+                onboarded=bool(onboarded),
+            )
+        for number, milli_bac, taken_at in self.connection.execute(
+            "SELECT number, milli_bac, taken_at FROM tests ORDER BY id"
+        ):
+            if number in users:
+                history = users[number].test_history
+                history.taken_at.append(taken_at)
+                history.milli_bac.append(milli_bac)
+        return users
+
+    def close(self):
+        self.connection.close()
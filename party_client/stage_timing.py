@@ -0,0 +1,86 @@
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from async_worker import percentile
+from globals import stage_timing
+from metrics import Histogram
+
+stage_seconds = Histogram(
+    "party_stage_seconds",
+    "Time spent in each stage of a breathalyzer test, as recorded by stage_timings.",
+    ["stage"],
+)
+
+
+class StageTimings:
+    """Rolling latency samples for each stage of the blow -> reading -> board pipeline.
+
+    The rolling window is a deque append, which needs no lock; each sample also goes
+    to the party_stage_seconds histogram, which takes that stage's per-child lock.
+    Those locks are only contended when two threads finish the same stage at once.
+    A record costs about 1 us and a span about 2.5 us (`benchmarks.py stage_timing`).
+    """
+
+    def __init__(self, window=stage_timing["window"]):
+        self.window = window
+        self.samples = {}  # stage -> deque of seconds, first-recorded stage first
+        self.reporter = None
+        self.stopped = threading.Event()
+
+    def record(self, stage, seconds):
+        samples = self.samples.get(stage)
+        if samples is None:
+            samples = self.samples.setdefault(stage, deque(maxlen=self.window))
+        samples.append(seconds)
+        stage_seconds.labels(stage).observe(seconds)
+
+    @contextmanager
+    def span(self, stage):
+        """Time the block as stage, failures included since they are often the slow ones."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def stats(self):
+        stats = {}
+        for stage, samples in list(self.samples.items()):
+            ordered = sorted(samples)
+            stats[stage] = {
+                "count": len(ordered),
+                "p50_ms": percentile(ordered, 50) * 1000,
+                "p95_ms": percentile(ordered, 95) * 1000,
+                "p99_ms": percentile(ordered, 99) * 1000,
+            }
+        return stats
+
+    def summary(self):
+        """One "stage p50/p95/p99 ms (samples)" line per stage."""
+        return "\n".join(
+            f"{stage} {s['p50_ms']:.0f}/{s['p95_ms']:.0f}/{s['p99_ms']:.0f} ms ({s['count']})"
+            for stage, s in self.stats().items()
+        )
+
+    def start_reporting(self, interval=stage_timing["log_interval_seconds"]):
+        """Dump the summary to the log every interval seconds from a daemon thread."""
+        if self.reporter is not None or not interval:
+            return
+        self.reporter = threading.Thread(
+            target=self.report, args=(interval,), name="stage-timing", daemon=True
+        )
+        self.reporter.start()
+
+    def report(self, interval):
+        while not self.stopped.wait(interval):
+            if self.samples:
+                logging.info(f"Stage latency p50/p95/p99:\n{self.summary()}")
+
+    def close(self):
+        self.stopped.set()
+
+
+stage_timings = StageTimings()
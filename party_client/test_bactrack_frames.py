@@ -0,0 +1,80 @@
+import random
+import unittest
+
+from bactrack_frames import Frame, Stage, decode_frame, results_stage
+from ble_simulator import encode_frame
+
+
+def if_chain_reading(data):
+    """How the old test_results_listener formatted the reading: float division, then round."""
+    return f"{((data[3] & 255) * 256 + (data[4] & 255)) / 10000.0:.3f}"
+
+
+class DecodeFrameTest(unittest.TestCase):
+    def test_every_stage_and_countdown(self):
+        for stage in Stage:
+            for countdown in range(16):
+                frame = decode_frame(encode_frame(stage, countdown=countdown))
+                self.assertIs(frame.stage, stage)
+                self.assertEqual(frame.countdown, countdown)
+                if stage is Stage.KEEP_BLOWING and countdown == 0:
+                    self.assertEqual(frame.description, "STOP_BLOWING")
+                else:
+                    self.assertEqual(frame.description, stage.name)
+
+    def test_readings_match_the_old_decoder(self):
+        for raw_reading in range(0x10000):
+            data = encode_frame(results_stage, reading=raw_reading)
+            frame = decode_frame(data)
+            self.assertEqual(frame.raw_reading, raw_reading)
+            # only exact .xxx5 halves may differ, the old float rounded those to even
+            if raw_reading % 10 != 5:
+                self.assertEqual(frame.reading, if_chain_reading(data), raw_reading)
+
+    def test_halves_round_up(self):
+        self.assertEqual(decode_frame(encode_frame(5, reading=445)).reading, "0.045")
+        self.assertEqual(decode_frame(encode_frame(5, reading=455)).reading, "0.046")
+
+    def test_any_buffer(self):
+        data = encode_frame(5, countdown=3, reading=812)
+        expected = decode_frame(data)
+        for buffer in (bytearray(data), memoryview(data), memoryview(bytearray(data))):
+            self.assertEqual(decode_frame(buffer), expected)
+
+    def test_upper_nibbles_are_ignored(self):
+        data = bytearray(encode_frame(3, countdown=2))
+        data[2] |= 0xA0
+        data[5] |= 0x50
+        self.assertEqual(decode_frame(data), decode_frame(encode_frame(3, countdown=2)))
+
+    def test_unknown_stages_are_rejected(self):
+        for stage in (0, 6, 15):
+            self.assertIsNone(decode_frame(encode_frame(stage)))
+
+    def test_frames_are_immutable(self):
+        frame = decode_frame(encode_frame(5, reading=450))
+        with self.assertRaises(AttributeError):
+            frame.raw_reading = 0
+        with self.assertRaises(AttributeError):
+            frame.extra = 1
+        self.assertFalse(hasattr(frame, "__dict__"))
+        self.assertEqual(frame, Frame(results_stage, 0, "ATTAINED_RESULTS", 450))
+
+    def test_fuzz_malformed_payloads(self):
+        fuzz = random.Random(0)
+        for _ in range(20000):
+            length = fuzz.choice((0, 1, 2, 5, 12, 13, 13, 13, 14, 20, 64))
+            data = bytearray(fuzz.getrandbits(8) for _ in range(length))
+            frame = decode_frame(data)
+            if length != 13:
+                self.assertIsNone(frame, data.hex())
+            elif data[2] & 0x0F not in set(Stage):
+                self.assertIsNone(frame, data.hex())
+            else:
+                self.assertEqual(frame.countdown, data[5] & 0x0F, data.hex())
+                self.assertEqual(frame.reading.count("."), 1, data.hex())
+                self.assertTrue(frame.description, data.hex())
+
+
+if __name__ == "__main__":
+    unittest.main()
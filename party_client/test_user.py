@@ -0,0 +1,103 @@
+import tempfile
+import unittest
+
+from leaderboard import Leaderboard
+from user import (
+    GameStateJournal,
+    PersistenceWriter,
+    StateRecorder,
+    User,
+    apply_journal_record,
+)
+
+
+class RecordingStore(StateRecorder):
+    """Keeps every batch the writer hands it, in order."""
+
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+
+    def append_many(self, users, records):
+        self.batches.append(list(records))
+
+
+def make_users(*numbers):
+    users = {"leaders": Leaderboard()}
+    for number in numbers:
+        users[number] = User(number, username=f"guest{number[-2:]}")
+    return users
+
+
+class PersistenceWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.store = RecordingStore()
+        # a long interval, so everything below lands in one batch when flushed
+        self.writer = PersistenceWriter(self.store, flush_interval_ms=60000)
+        self.addCleanup(self.writer.close)
+
+    def test_coalesced_records_keep_their_first_position(self):
+        users = make_users("+15550000001")
+        self.writer.record_user(users, "+15550000001")
+        self.writer.record_test(users, "+15550000001", "0.045", 100.0)
+        users["+15550000001"].next_step = "gameplay"
+        self.writer.record_user(users, "+15550000001")
+        self.writer.flush()
+
+        (batch,) = self.store.batches
+        self.assertEqual([record["op"] for record in batch], ["user", "test"])
+        self.assertEqual(batch[0]["user"]["next_step"], "gameplay")
+        self.assertEqual(self.writer.stats()["coalesced_records"], 1)
+
+    def test_flushed_batch_replays_every_reading(self):
+        users = make_users("+15550000001")
+        self.writer.record_user(users, "+15550000001")
+        self.writer.record_test(users, "+15550000001", "0.045", 100.0)
+        self.writer.record_user(users, "+15550000001")
+        self.writer.flush()
+
+        replayed = {"leaders": Leaderboard()}
+        for record in self.store.batches[0]:
+            apply_journal_record(replayed, record)
+        self.assertEqual(
+            list(replayed["+15550000001"].test_history), [(100.0, "0.045")]
+        )
+
+
+class ReplayTest(unittest.TestCase):
+    def test_reading_already_in_the_snapshot_is_not_doubled(self):
+        users = make_users("+15550000001")
+        users["+15550000001"].test_history.append("0.045", 100.0)
+        record = {
+            "op": "test",
+            "number": "+15550000001",
+            "reading": "0.045",
+            "timestamp": 100.0,
+        }
+        apply_journal_record(users, record)
+        apply_journal_record(users, dict(record, reading="0.050", timestamp=200.0))
+        self.assertEqual(
+            list(users["+15550000001"].test_history),
+            [(100.0, "0.045"), (200.0, "0.050")],
+        )
+
+    def test_restore_after_compaction_with_the_reading_journaled_again(self):
+        with tempfile.TemporaryDirectory() as backup_dir:
+            users = make_users("+15550000001")
+            users["+15550000001"].test_history.append("0.045", 100.0)
+            journal = GameStateJournal(backup_dir)
+            # the snapshot already holds the reading, then its record reaches the journal
+            journal.compact(users)
+            journal.record_test(users, "+15550000001", "0.045", 100.0)
+            journal.record_test(users, "+15550000001", "0.050", 200.0)
+            journal.close()
+
+            restored = GameStateJournal(backup_dir).restore()
+            self.assertEqual(
+                list(restored["+15550000001"].test_history),
+                [(100.0, "0.045"), (200.0, "0.050")],
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
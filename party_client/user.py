@@ -1,17 +1,114 @@
+import atexit
+import base64
 import json
 import logging
 import os
+import sys
+import threading
 import time
+from abc import ABC, abstractmethod
+from array import array
 
 from globals import game_state
-from sortedcontainers import SortedDict
+from leaderboard import Leaderboard
+from metrics import Counter, Histogram
 from datetime import datetime
 
+flush_seconds = Histogram(
+    "party_persistence_flush_seconds",
+    "Time the persistence writer spends handing one batch to the state store.",
+)
+flush_bytes = Counter(
+    "party_persistence_flush_bytes_total",
+    "Bytes the persistence writer appended to the journal (0 with the SQLite backend).",
+)
 
 onboarding_flow = ["new_user", "register_user", "agree_to_terms", "gameplay"]
 
 
+class TestHistory:
+    """Every reading a guest has taken, as parallel epoch-seconds and milli-BAC columns."""
+
+    __slots__ = ("taken_at", "milli_bac")
+
+    def __init__(self):
+        self.taken_at = array("d")
+        self.milli_bac = array("H")
+
+    def append(self, reading, taken_at):
+        self.taken_at.append(taken_at)
+        self.milli_bac.append(round(float(reading) * 1000))
+
+    def __len__(self):
+        return len(self.milli_bac)
+
+    def covers(self, taken_at):
+        """Whether a reading taken at taken_at is already here; readings only ever arrive in time order."""
+        count = len(self.milli_bac)
+        return count > 0 and taken_at <= self.taken_at[count - 1]
+
+    def __iter__(self):
+        for taken_at, milli_bac in zip(self.taken_at, self.milli_bac):
+            yield taken_at, f"{milli_bac / 1000:.3f}"
+
+    def __str__(self):
+        return ", ".join(
+            f"{reading} at {datetime.fromtimestamp(taken_at).strftime('%H:%M')}"
+            for taken_at, reading in self
+        )
+
+    def to_bytes(self):
+        # milli_bac is appended second, so its length only counts complete readings
+        count = len(self.milli_bac)
+        taken_at = array("d", self.taken_at[:count])
+        milli_bac = array("H", self.milli_bac[:count])
+        if (
+            sys.byteorder == "big"
+        ):  # stored little-endian so backups move between machines
+            taken_at.byteswap()
+            milli_bac.byteswap()
+        return taken_at.tobytes() + milli_bac.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        history = cls()
+        count = len(data) // (history.taken_at.itemsize + history.milli_bac.itemsize)
+        split = count * history.taken_at.itemsize
+        history.taken_at.frombytes(data[:split])
+        history.milli_bac.frombytes(data[split:])
+        if sys.byteorder == "big":
+            history.taken_at.byteswap()
+            history.milli_bac.byteswap()
+        return history
+
+    def encode(self):
+        return base64.b64encode(self.to_bytes()).decode("ascii")
+
+    @classmethod
+    def decode(cls, data):
+        if isinstance(
+            data, dict
+        ):  # backups from before the binary format: {reading: "%Y-%m-%d %H:%M:%S"}
+            history = cls()
+            for taken_at, reading in sorted(
+                (datetime.strptime(taken_at, "%Y-%m-%d %H:%M:%S").timestamp(), reading)
+                for reading, taken_at in data.items()
+            ):
+                history.append(reading, taken_at)
+            return history
+        return cls.from_bytes(base64.b64decode(data or ""))
+
+
 class User:
+    __slots__ = (
+        "number",
+        "username",
+        "next_step",
+        "agreed_to_terms",
+        "onboarded",
+        "test_history",
+    )
+
     def __init__(
         self,
         number,
@@ -25,7 +122,7 @@ class User:
         self.next_step = next_step
         self.agreed_to_terms = agree_to_terms
         self.onboarded = onboarded
-        self.test_history = SortedDict()
+        self.test_history = TestHistory()
 
     def to_dict(self):
         return {
@@ -34,71 +131,393 @@ class User:
             "next_step": self.next_step,
             "agreed_to_terms": self.agreed_to_terms,
             "onboarded": self.onboarded,
-            "test_history": self.test_history,
+            "test_history": self.test_history.encode(),
         }
 
     @classmethod
     def from_dict(cls, data):
-        return cls(
+        user = cls(
             number=data["number"],
             username=data.get("username"),
             next_step=data.get("next_step", "register_user"),
             agree_to_terms=data.get("agreed_to_terms", False),
             onboarded=data.get("onboarded", False),
         )
+        user.test_history = TestHistory.decode(data.get("test_history"))
+        return user
 
 
-def persist_users_data(users):
-    backup_file = os.path.join(os.getcwd(), game_state["backup_file_name"])
+def persist_users_data(users, backup_dir=None):
+    backup_dir = backup_dir or os.getcwd()
+    backup_file = os.path.join(backup_dir, game_state["backup_file_name"])
 
-    if not os.path.isdir(os.getcwd()):
+    if not os.path.isdir(backup_dir):
         logging.info(
-            f"Backup file directory '{os.getcwd()}' not found. Unable to persist user state data."
+            f"Backup file directory '{backup_dir}' not found. Unable to persist user state data."
         )
         return ""
 
     logging.info("In persist_users_data")
 
-    for i in range(len(users["leaders"])):
-        if isinstance(users["leaders"][i][2], datetime):
-            users["leaders"][i][2] = users["leaders"][i][2].isoformat()
-
     serializable_data = {
-        key: user if key == "leaders" else user.to_dict() for key, user in users.items()
+        key: user.to_list() if key == "leaders" else user.to_dict()
+        for key, user in list(users.items())
     }
-    with open(backup_file, "w") as json_file:
+    # write to a temp file and swap it in, so a crash mid-write never leaves a torn snapshot
+    temp_file = backup_file + ".tmp"
+    with open(temp_file, "w") as json_file:
         logging.info("Writing users dictionary to json file.")
         json.dump(serializable_data, json_file, indent=4)
+    os.replace(temp_file, backup_file)
     return ""
 
 
-def restore_user_states():
-    backup_file = os.path.join(os.getcwd(), game_state["backup_file_name"])
+class StateRecorder(ABC):
+    """Turns game state mutations into records, subclasses decide where the records go."""
+
+    def __init__(self):
+        self.bytes_written = 0  # stores that know what they wrote keep this up to date
+
+    def record_user(self, users, number):
+        user = users.get(number)
+        if user is not None:
+            user_data = user.to_dict()
+            user_data.pop(
+                "test_history"
+            )  # readings are journaled one by one via record_test
+            self.append(users, {"op": "user", "user": user_data})
+
+    def record_user_removal(self, users, number):
+        self.append(users, {"op": "remove_user", "number": number})
+
+    def record_leader(self, users, username, bac_value, reading_time):
+        if isinstance(reading_time, datetime):
+            reading_time = reading_time.isoformat()
+        self.append(
+            users,
+            {
+                "op": "leader",
+                "username": username,
+                "bac": bac_value,
+                "time": reading_time,
+            },
+        )
+
+    def record_test(self, users, number, reading, timestamp):
+        self.append(
+            users,
+            {
+                "op": "test",
+                "number": number,
+                "reading": reading,
+                "timestamp": timestamp,
+            },
+        )
+
+    def append(self, users, record):
+        self.append_many(users, [record])
+
+    @abstractmethod
+    def append_many(self, users, records):
+        """Hand records, in order, to wherever this recorder keeps them."""
+
+    def compaction_due(self, record_count):
+        """Whether appending record_count more records makes the store compact from users."""
+        return False
+
+    def flush(self):
+        return
 
+    def close(self):
+        return
+
+
+class GameStateJournal(StateRecorder):
+    """Append-only log of game state mutations, periodically compacted into the JSON snapshot."""
+
+    def __init__(
+        self,
+        backup_dir=None,
+        compaction_threshold=game_state["journal_compaction_threshold"],
+    ):
+        super().__init__()
+        self.backup_dir = backup_dir or os.getcwd()
+        self.journal_file = os.path.join(
+            self.backup_dir,
+            game_state["backup_file_name"] + game_state["journal_suffix"],
+        )
+        self.compaction_threshold = compaction_threshold
+        self.records_since_compaction = count_journal_records(self.journal_file)
+        self.journal = None
+
+    def restore(self):
+        return restore_user_states(self.backup_dir)
+
+    def append_many(self, users, records):
+        if not os.path.isdir(self.backup_dir):
+            logging.info(
+                f"Backup file directory '{self.backup_dir}' not found. Unable to journal user state data."
+            )
+            return
+        if self.journal is None:
+            self.journal = open(self.journal_file, "a")
+        # json.dumps escapes everything to ASCII, so characters are bytes
+        self.bytes_written += self.journal.write(
+            "".join(
+                json.dumps(record, separators=(",", ":")) + "\n" for record in records
+            )
+        )
+        self.journal.flush()
+        self.records_since_compaction += len(records)
+
+        if self.records_since_compaction >= self.compaction_threshold:
+            self.compact(users)
+
+    def compaction_due(self, record_count):
+        return self.records_since_compaction + record_count >= self.compaction_threshold
+
+    def compact(self, users):
+        logging.info(
+            f"Compacting {self.records_since_compaction} journal records into snapshot"
+        )
+        persist_users_data(users, self.backup_dir)
+        # snapshot is durable, so the journal tail it covers can be dropped
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = open(self.journal_file, "w")
+        self.records_since_compaction = 0
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+
+class PersistenceWriter(StateRecorder):
+    """Coalesces records on a background thread and hands them to a state store at most once per interval."""
+
+    def __init__(
+        self,
+        store,
+        flush_interval_ms=game_state["flush_interval_ms"],
+        snapshot=None,
+    ):
+        super().__init__()
+        self.store = store
+        self.flush_interval = flush_interval_ms / 1000
+        # snapshot(users) gives a copy that is safe to iterate while handlers keep mutating users
+        self.snapshot = snapshot or (lambda users: users)
+
+        self.condition = threading.Condition()
+        self.store_lock = (
+            threading.Lock()
+        )  # the store is driven by the writer thread and compact()
+        self.pending = {}  # record key -> latest record, in first-dirtied order
+        self.pending_users = None
+        self.is_flushing = False
+        self.force_flush = False
+        self.is_running = True
+        self.last_flush_time = 0.0
+
+        self.submitted_records = 0  # logical writes handed to the writer
+        self.coalesced_records = 0  # logical writes superseded before reaching disk
+        self.physical_writes = 0  # journal writes actually issued
+
+        self.thread = threading.Thread(
+            target=self.run, name="persistence-writer", daemon=True
+        )
+        self.thread.start()
+        atexit.register(self.close)
+
+    def record_key(self, record):
+        if record["op"] in ("user", "remove_user"):
+            return ("user", record.get("number") or record["user"]["number"])
+        if record["op"] == "leader":
+            return ("leader", record["username"])
+        return (record["op"], self.submitted_records)  # test readings never supersede
+
+    def append_many(self, users, records):
+        with self.condition:
+            for record in records:
+                self.submitted_records += 1
+                key = self.record_key(record)
+                if key in self.pending:
+                    self.coalesced_records += 1
+                # assigning in place keeps the key's first position: a guest's user record must
+                # still come before their test readings, or replay drops the readings
+                self.pending[key] = record
+            self.pending_users = users
+            self.condition.notify_all()
+
+    def record_user_removal(self, users, number):
+        # opted out guests expect their data gone, don't leave it sitting in memory
+        super().record_user_removal(users, number)
+        self.flush()
+
+    def flush(self):
+        with self.condition:
+            self.force_flush = True
+            self.condition.notify_all()
+            while (self.pending or self.is_flushing) and self.thread.is_alive():
+                self.condition.wait(timeout=1)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.is_running and not self.pending:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                # bounded staleness: hold off until the interval since the last write elapses
+                while self.is_running and not self.force_flush:
+                    delay = (
+                        self.last_flush_time + self.flush_interval - time.monotonic()
+                    )
+                    if delay <= 0:
+                        break
+                    self.condition.wait(timeout=delay)
+
+                records = list(self.pending.values())
+                users = self.pending_users
+                # compaction walks every user, so hand it a consistent copy rather than the live
+                # dict, taken with the batch so no later record can slip into it as well
+                if self.store.compaction_due(len(records)):
+                    users = self.snapshot(users)
+                self.pending = {}
+                self.force_flush = False
+                self.is_flushing = True
+
+            try:
+                with self.store_lock:
+                    start = time.perf_counter()
+                    bytes_before = self.store.bytes_written
+                    self.store.append_many(users, records)
+                    flush_seconds.observe(time.perf_counter() - start)
+                    flush_bytes.inc(self.store.bytes_written - bytes_before)
+            except Exception as e:
+                logging.error(
+                    f"Persistence writer failed to flush {len(records)} records: {e}"
+                )
+            finally:
+                with self.condition:
+                    self.physical_writes += 1
+                    self.last_flush_time = time.monotonic()
+                    self.is_flushing = False
+                    self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "submitted_records": self.submitted_records,
+                "coalesced_records": self.coalesced_records,
+                "physical_writes": self.physical_writes,
+                "pending_records": len(self.pending),
+            }
+
+    def close(self):
+        with self.condition:
+            if not self.is_running:
+                return
+            self.is_running = False
+            self.condition.notify_all()
+        self.thread.join()
+        logging.info(f"Persistence writer stopped with stats {self.stats()}")
+        self.store.close()
+
+    def restore(self):
+        return self.store.restore()
+
+    def compact(self, users):
+        self.flush()
+        with self.store_lock:
+            self.store.compact(self.snapshot(users))
+
+
+def count_journal_records(journal_file):
+    if not os.path.isfile(journal_file):
+        return 0
+    with open(journal_file, "r") as journal:
+        return sum(1 for _ in journal)
+
+
+def apply_journal_record(users, record):
+    op = record.get("op")
+    if op == "user":
+        user = User.from_dict(record["user"])
+        if user.number in users:
+            user.test_history = users[user.number].test_history
+        users[user.number] = user
+    elif op == "remove_user":
+        users.pop(record["number"], None)
+    elif op == "leader":
+        users["leaders"].upsert(record["username"], record["bac"], record["time"])
+    elif op == "test":
+        user = users.get(record["number"])
+        # the snapshot is a shallow copy, so a reading taken while it was written can be in
+        # both the snapshot and the journal after it; replaying it again would double it
+        if user is not None and not user.test_history.covers(record["timestamp"]):
+            user.test_history.append(record["reading"], record["timestamp"])
+    else:
+        logging.warning(f"Skipping unknown journal record: {record}")
+
+
+def replay_journal(users, journal_file):
+    if not os.path.isfile(journal_file):
+        return users
+
+    replayed = 0
+    with open(journal_file, "r") as journal:
+        for line in journal:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # a crash mid-append can only tear the final record
+                logging.warning("Dropping torn record at end of journal")
+                break
+            apply_journal_record(users, record)
+            replayed += 1
+    logging.info(f"Replayed {replayed} journal records from {journal_file}")
+    return users
+
+
+def load_snapshot(backup_file):
     if not os.path.isfile(backup_file):
+        logging.info(
+            f"Backup file '{backup_file}' not found. Starting from empty snapshot."
+        )
+        return {"leaders": Leaderboard()}
+
+    with open(backup_file, "r") as json_file:
+        loaded_data = json.load(json_file)
+    logging.info(f"Restoring state of Users in game from file: {backup_file}")
+    return {
+        key: Leaderboard.from_list(value) if key == "leaders" else User.from_dict(value)
+        for key, value in loaded_data.items()
+    }
+
+
+def restore_user_states(backup_dir=None):
+    backup_dir = backup_dir or os.getcwd()
+    backup_file = os.path.join(backup_dir, game_state["backup_file_name"])
+    journal_file = backup_file + game_state["journal_suffix"]
+
+    modified_times = [
+        os.path.getmtime(path)
+        for path in (backup_file, journal_file)
+        if os.path.isfile(path)
+    ]
+    if not modified_times:
         logging.info(
             f"Backup file '{backup_file}' not found. Defaulting to empty users list."
         )
-        return {"leaders": []}
+        return {"leaders": Leaderboard()}
 
-    modified_time = os.path.getmtime(backup_file)
-    # Check if the file was modified within the allowed threshold (in hours)
-    if (time.time() - modified_time) / 3600 <= game_state["backup_edit_threshold"]:
+    # Check if the state was modified within the allowed threshold (in hours)
+    if (time.time() - max(modified_times)) / 3600 <= game_state[
+        "backup_edit_threshold"
+    ]:
         try:
-            with open(backup_file, "r") as json_file:
-                loaded_data = json.load(json_file)
-            logging.info(f"Restoring state of Users in game from file: {backup_file}")
-            restored_users = {
-                key: value if key == "leaders" else User.from_dict(value)
-                for key, value in loaded_data.items()
-            }
-
-            for i in range(len(restored_users["leaders"])):
-                if isinstance(restored_users["leaders"][i][2], str):
-                    restored_users["leaders"][i][2] = datetime.fromisoformat(
-                        restored_users["leaders"][i][2]
-                    )
-            return restored_users
+            return replay_journal(load_snapshot(backup_file), journal_file)
         except json.JSONDecodeError as e:
             logging.info(
                 f"Error decoding JSON backup: {e}. Defaulting to empty users list."
@@ -111,4 +530,4 @@ def restore_user_states():
         logging.info(
             f"Backup file '{backup_file}' is older than the threshold. Defaulting to empty users list."
         )
-    return {"leaders": []}
+    return {"leaders": Leaderboard()}
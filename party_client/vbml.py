@@ -0,0 +1,280 @@
+import json
+import os
+import re
+import sys
+
+# Vestaboard character codes for everything a template can contain as plain text
+character_codes = {
+    " ": 0,
+    **{chr(ord("A") + i): i + 1 for i in range(26)},
+    **{str(digit): 26 + digit for digit in range(1, 10)},
+    "0": 36,
+    "!": 37,
+    "@": 38,
+    "#": 39,
+    "$": 40,
+    "(": 41,
+    ")": 42,
+    "-": 44,
+    "+": 46,
+    "&": 47,
+    "=": 48,
+    ";": 49,
+    ":": 50,
+    "'": 52,
+    '"': 53,
+    "%": 54,
+    ",": 55,
+    ".": 56,
+    "/": 59,
+    "?": 60,
+    "°": 62,
+}
+
+# typographic characters phones love to send, folded onto what the board can show
+character_substitutions = {
+    "‘": "'",
+    "’": "'",
+    "“": '"',
+    "”": '"',
+    "–": "-",
+    "—": "-",
+    "…": "...",
+}
+
+escape_pattern = re.compile(r"\{(\d{1,2})\}")
+max_character_code = 71
+blank = character_codes[" "]
+newline = -1  # marker, never reaches the board
+
+
+def template_to_codes(template):
+    """Character codes for a template, with {NN} escapes resolved and unsupported characters dropped."""
+    codes = []
+    position = 0
+    for escape in escape_pattern.finditer(template):
+        codes.extend(text_to_codes(template[position : escape.start()]))
+        code = int(escape.group(1))
+        if code <= max_character_code:
+            codes.append(code)
+        position = escape.end()
+    codes.extend(text_to_codes(template[position:]))
+    return codes
+
+
+def text_to_codes(text):
+    codes = []
+    for character in text.upper():
+        character = character_substitutions.get(character, character)
+        for part in character:
+            if part == "\n":
+                codes.append(newline)
+            elif part in character_codes:
+                codes.append(character_codes[part])
+    return codes
+
+
+def wrap_codes(codes, width):
+    """Greedy word wrap that keeps runs of spaces inside a line, since our templates pad with them."""
+    lines = []
+    for paragraph in split_on(codes, newline):
+        line = []
+        for word, gap in words_and_gaps(paragraph):
+            if line and len(line) + len(gap) + len(word) > width:
+                lines.append(line)
+                line = []
+                gap = []  # the space a line breaks on is dropped
+            line.extend(gap)
+            # words longer than the component get split
+            while len(line) + len(word) > width:
+                room = width - len(line)
+                line.extend(word[:room])
+                lines.append(line)
+                line, word = [], word[room:]
+            line.extend(word)
+        lines.append(line)
+    return lines
+
+
+def split_on(codes, marker):
+    chunk = []
+    for code in codes:
+        if code == marker:
+            yield chunk
+            chunk = []
+        else:
+            chunk.append(code)
+    yield chunk
+
+
+def words_and_gaps(codes):
+    """Yield (word, spaces before it) pairs; trailing spaces come back with an empty word."""
+    gap, word = [], []
+    for code in codes:
+        if code == blank:
+            if word:
+                yield word, gap
+                gap, word = [], []
+            gap.append(code)
+        else:
+            word.append(code)
+    if word or gap:
+        yield word, gap
+
+
+def justify_lines(lines, width, justify):
+    lines = [strip_blanks(line) for line in lines]
+    block_width = max((len(line) for line in lines), default=0)
+    justified = []
+    for line in lines:
+        if justify == "right":
+            left = width - len(line)
+        elif justify == "center":
+            left = (width - len(line)) // 2
+        elif justify == "justified":
+            # the block is centered, lines stay left-aligned inside it
+            left = (width - block_width) // 2
+        else:
+            left = 0
+        justified.append([blank] * left + line + [blank] * (width - left - len(line)))
+    return justified
+
+
+def strip_blanks(line):
+    start, end = 0, len(line)
+    while start < end and line[start] == blank:
+        start += 1
+    while end > start and line[end - 1] == blank:
+        end -= 1
+    return line[start:end]
+
+
+def align_lines(lines, width, height, align):
+    lines = lines[:height]
+    if align == "bottom":
+        top = height - len(lines)
+    elif align in ("center", "justified"):
+        top = (height - len(lines)) // 2
+    else:
+        top = 0
+    empty = [blank] * width
+    return [empty] * top + lines + [empty] * (height - top - len(lines))
+
+
+def render_component(template, width, height, justify, align):
+    lines = wrap_codes(template_to_codes(template), width)
+    return align_lines(justify_lines(lines, width, justify), width, height, align)
+
+
+def style_fields(style):
+    position = style.absolutePosition
+    return {
+        "width": style.width,
+        "height": style.height,
+        "justify": style.justify,
+        "align": style.align,
+        "absolutePosition": (
+            None if position is None else {"x": position.x, "y": position.y}
+        ),
+    }
+
+
+def render_vbml(message, board_height=6, board_width=22):
+    """Render a vestaboard_client.Message into the board's rows of character codes, like the VBML API does."""
+    return render_board(
+        [
+            (component.template, style_fields(component.style))
+            for component in message.components
+        ],
+        board_height,
+        board_width,
+    )
+
+
+def render_board(components, board_height=6, board_width=22):
+    board = [[blank] * board_width for _ in range(board_height)]
+    cursor_x, cursor_y, row_height = 0, 0, 0
+    for template, style in components:
+        width = style.get("width") or board_width
+        height = style.get("height") or board_height
+        rendered = render_component(
+            template,
+            width,
+            height,
+            style.get("justify") or "left",
+            style.get("align") or "top",
+        )
+
+        position = style.get("absolutePosition")
+        if position is not None:
+            x, y = position.get("x", 0), position.get("y", 0)
+        else:
+            # components without a position flow left to right, then wrap down a row
+            if cursor_x + width > board_width:
+                cursor_x, cursor_y, row_height = 0, cursor_y + row_height, 0
+            x, y = cursor_x, cursor_y
+            cursor_x += width
+            row_height = max(row_height, height)
+
+        for r, row in enumerate(rendered):
+            for c, code in enumerate(row):
+                if 0 <= y + r < board_height and 0 <= x + c < board_width:
+                    board[y + r][x + c] = code
+    return board
+
+
+golden_corpus_file = os.path.join(os.path.dirname(__file__), "vbml_golden.json")
+api_source = "vbml_api"  # recorded_from once make vbml-golden-record has run
+
+
+def load_golden_corpus(corpus_file=golden_corpus_file):
+    """{"recorded_from": api_source or None, "cases": [{name, template, style, expected}]}"""
+    with open(corpus_file, "r") as corpus:
+        return json.load(corpus)
+
+
+def check_golden_corpus(corpus_file=golden_corpus_file):
+    """Names of the cases the local renderer does not reproduce, unrecorded ones included."""
+    failures = []
+    for case in load_golden_corpus(corpus_file)["cases"]:
+        expected = case.get("expected")
+        if (
+            expected is None
+            or render_board([(case["template"], case["style"])]) != expected
+        ):
+            failures.append(case["name"])
+    return failures
+
+
+def record_golden_corpus(convert, corpus_file=golden_corpus_file):
+    """Record every case's expected array with convert(template, style), the remote VBML API."""
+    corpus = load_golden_corpus(corpus_file)
+    for case in corpus["cases"]:
+        case["expected"] = convert(case["template"], case["style"])
+    corpus["recorded_from"] = api_source
+    with open(corpus_file, "w") as corpus_out:
+        json.dump(corpus, corpus_out, indent=4)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["record"]:
+        from vestaboard_client import Message, SubMessage, SubMessageStyle
+        from vestaboard_client import convert_vbml_to_array_remote
+
+        def convert_remotely(template, style):
+            message = Message(
+                components=[
+                    SubMessage(template=template, style=SubMessageStyle(**style))
+                ]
+            )
+            response_code, response = convert_vbml_to_array_remote(message)
+            if not 200 <= response_code < 300:
+                raise RuntimeError(f"VBML API answered {response_code}")
+            return response
+
+        record_golden_corpus(convert_remotely)
+        print(f"Recorded {golden_corpus_file} from the VBML API")
+    else:
+        # the parity check itself is test_vbml.py, run by make test
+        print("usage: python3 vbml.py record")
+        sys.exit(2)
@@ -1,6 +1,14 @@
 import ast
-import subprocess
-from socket import socket
+import atexit
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from enum import IntEnum
 
 import requests
 
@@ -8,6 +16,10 @@ from pydantic import BaseModel, Field
 from typing import List, Optional
 
 from globals import vestaboard_metadata
+from http_client import shared_http_client
+from log_setup import truncate
+from stage_timing import stage_timings
+from vbml import render_vbml
 import logging
 
 
@@ -51,15 +63,38 @@ class Vestaboard:
         min_char_code=vestaboard_metadata["default_min_char_code"],
         max_char_code=vestaboard_metadata["default_max_char_code"],
         ip_address_alternate=None,
+        seed_frame_from_board=vestaboard_metadata["seed_frame_from_board"],
+        health_check_interval=vestaboard_metadata["health_check_interval_seconds"],
     ):
         self.x_api_key = x_api_key
         self.base_headers = {"X-Vestaboard-Local-Api-Key": self.x_api_key}
+        self.ip_addresses = [ip for ip in (ip_address, ip_address_alternate) if ip]
+        self.endpoint_latency = (
+            {}
+        )  # ip -> last connect latency in seconds, None if down
+        self.failovers = 0
         self.url = self.establish_connection(ip_address, ip_address_alternate)
         self.height = height
         self.width = width
         self.min_char_code = min_char_code
         self.max_char_code = max_char_code
 
+        # shadow copy of the last frame the board accepted, None until we know what it shows
+        self.last_frame = None
+        self.writes = 0
+        self.skipped_writes = 0
+        self.changed_cells = 0
+        self.last_changed_cells = None
+        if seed_frame_from_board:
+            self.seed_last_frame()
+
+        if health_check_interval and self.ip_addresses:
+            self.health_check_interval = health_check_interval
+            self.monitor_thread = threading.Thread(
+                target=self.monitor_health, name="vestaboard-health", daemon=True
+            )
+            self.monitor_thread.start()
+
     def validate_message(self, message: bytes):
         if (
             not message
@@ -88,75 +123,421 @@ class Vestaboard:
 
         return True
 
+    def diff_frame(self, message):
+        """Number of cells that would flip if message were written, every cell if the board is unknown."""
+        if self.last_frame is None:
+            return self.height * self.width
+        return sum(
+            new != old
+            for new_row, old_row in zip(message, self.last_frame)
+            for new, old in zip(new_row, old_row)
+        )
+
     def send_msg(self, message: bytes):
         if self.url:
             headers = self.base_headers | {"Content-Type": "application/json"}
             if self.validate_message(message):
-                logging.info("Attempting write to Vestaboard")
-                response = requests.post(
-                    url=self.url, data=str(message), headers=headers
+                changed_cells = self.diff_frame(message)
+                self.last_changed_cells = changed_cells
+                if changed_cells == 0:
+                    self.skipped_writes += 1
+                    logging.info("Vestaboard already shows this frame, skipping write")
+                    # Not Modified: callers can tell a no-op from a write
+                    return 304, ""
+
+                logging.info(
+                    f"Attempting write to Vestaboard, {changed_cells} cells change"
                 )
+                try:
+                    response = shared_http_client.post(
+                        "vestaboard", url=self.url, data=str(message), headers=headers
+                    )
+                except requests.exceptions.RequestException as e:
+                    # the radio we were using dropped, retry once on the other one
+                    logging.warning(f"Write to Vestaboard at {self.url} failed: {e}")
+                    if not self.fail_over():
+                        raise
+                    response = shared_http_client.post(
+                        "vestaboard", url=self.url, data=str(message), headers=headers
+                    )
                 logging.info(f"Wrote to Vestaboard with Status: {response.status_code}")
+                if 200 <= response.status_code < 300:
+                    self.last_frame = [row[:] for row in message]
+                    self.writes += 1
+                    self.changed_cells += changed_cells
                 return response.status_code, response.text
 
+    def seed_last_frame(self):
+        try:
+            response_code, response_text = self.read_msg() or (None, "")
+            if response_code is None or not 200 <= response_code < 300:
+                return
+            frame = json.loads(response_text)
+            # the local API wraps the rows as {"message": [...]}
+            if isinstance(frame, dict):
+                frame = frame.get("message")
+            if self.validate_message(frame):
+                self.last_frame = frame
+                logging.info("Seeded Vestaboard shadow frame from the board")
+        except Exception as e:
+            logging.warning(f"Unable to seed Vestaboard shadow frame: {e}")
+
+    def frame_stats(self):
+        return {
+            "writes": self.writes,
+            "skipped_writes": self.skipped_writes,
+            "changed_cells": self.changed_cells,
+            "last_changed_cells": self.last_changed_cells,
+        }
+
     def read_msg(self):
         if self.url:
             logging.info("Attempting read from Vestaboard")
-            response = requests.get(url=self.url, headers=self.base_headers)
+            response = shared_http_client.get(
+                "vestaboard", url=self.url, headers=self.base_headers
+            )
             logging.info(f"Read from Vestaboard with Status: {response.status_code}")
             return response.status_code, response.text
 
+    def endpoint_url(self, ip_address):
+        return f"http://{ip_address}:{vestaboard_metadata['local_api_port']}/local-api/message"
+
     def establish_connection(self, ip_address, ip_address_alternate):
-        url = "http://{}:7000/local-api/message"
-        if self.check_connection(ip_address):
-            url = url.format(ip_address)
-        elif self.check_connection(ip_address_alternate):
-            url = url.format(ip_address_alternate)
-        else:
-            url = ""
-            logging.error("All attempts to connect to Vestaboard unsuccessful")
-        return url
-
-    def check_connection(self, ip_address, ping_timeout=2):
+        self.probe_endpoints()
+        # keep the old preference order: 2.4GHz first, 5GHz if it is the only one answering
+        for ip in (ip_address, ip_address_alternate):
+            if ip and self.endpoint_latency.get(ip) is not None:
+                return self.endpoint_url(ip)
+        logging.error("All attempts to connect to Vestaboard unsuccessful")
+        return ""
+
+    def probe_endpoints(self):
+        """Probe every endpoint at once, so a dead radio costs one timeout rather than one each."""
+        if not self.ip_addresses:
+            return
+        with ThreadPoolExecutor(max_workers=len(self.ip_addresses)) as executor:
+            latencies = executor.map(self.check_connection, self.ip_addresses)
+            self.endpoint_latency = dict(zip(self.ip_addresses, latencies))
+
+    def check_connection(
+        self, ip_address, probe_timeout=vestaboard_metadata["probe_timeout_seconds"]
+    ):
+        """TCP connect latency to the board's local API in seconds, None if it is unreachable."""
         if not ip_address:
-            return False
+            return None
+        start = time.monotonic()
         try:
-            logging.info(f"Attempting Vestaboard ping check to {ip_address}")
-            result = subprocess.run(
-                [
-                    "ping",
-                    "-c",
-                    "1",
-                    ip_address,
-                ],  # Use "-c 1" to send 1 ping request (Linux/Mac)
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                timeout=ping_timeout,
-            )
-            if result.returncode == 0:
-                logging.info(f"Ping to Vestaboard {ip_address} successful")
+            with socket.create_connection(
+                (ip_address, vestaboard_metadata["local_api_port"]),
+                timeout=probe_timeout,
+            ):
+                latency = time.monotonic() - start
+            logging.info(f"Vestaboard {ip_address} reachable in {latency * 1000:.0f}ms")
+            return latency
+        except OSError as e:
+            logging.warning(f"Vestaboard {ip_address} unreachable: {e}")
+            return None
+
+    def fail_over(self):
+        """Point writes at another reachable endpoint, True if we switched."""
+        self.probe_endpoints()
+        for ip, latency in sorted(
+            self.endpoint_latency.items(),
+            key=lambda item: float("inf") if item[1] is None else item[1],
+        ):
+            url = self.endpoint_url(ip)
+            if latency is not None and url != self.url:
+                logging.warning(f"Failing Vestaboard writes over to {ip}")
+                self.url = url
+                self.failovers += 1
                 return True
-            else:
-                logging.warning(
-                    f"Ping to Vestaboard {ip_address} failed: {result.stderr.strip()}"
+        return False
+
+    def monitor_health(self):
+        while True:
+            time.sleep(self.health_check_interval)
+            try:
+                self.probe_endpoints()
+                current = next(
+                    (
+                        ip
+                        for ip in self.ip_addresses
+                        if self.endpoint_url(ip) == self.url
+                    ),
+                    None,
                 )
-                return False
+                if current is None or self.endpoint_latency.get(current) is None:
+                    self.fail_over()
+            except Exception as e:
+                logging.error(f"Vestaboard health check failed: {e}")
+
+    def health_stats(self):
+        return {
+            "url": self.url,
+            "endpoint_latency": dict(self.endpoint_latency),
+            "failovers": self.failovers,
+        }
+
+
+class DisplayPriority(IntEnum):
+    IDLE = 0  # starter screen, shown when nothing else is going on
+    NORMAL = 1  # leaderboards and game announcements
+    ALERT = 2  # admin and superman messages
+
+
+class VestaboardDisplay:
+    """Single worker that owns the board: newest frame per priority wins, writes are spaced out.
+
+    Writing a frame expires every lower-priority frame queued before it, so an older
+    leaderboard can never land on top of a newer alert.
+    """
+
+    def __init__(
+        self,
+        vestaboard,
+        min_write_interval=vestaboard_metadata["min_write_interval_seconds"],
+    ):
+        self.vestaboard = vestaboard
+        self.min_write_interval = min_write_interval
+        self.condition = threading.Condition()
+        # DisplayPriority -> (newest Message waiting for the board, time it was queued, sequence)
+        self.pending = {}
+        self.sequence = 0  # orders submissions across priorities
+        self.last_write_time = float("-inf")
+        self.is_running = True
+
+        self.submitted_frames = 0
+        self.superseded_frames = 0
+        self.expired_frames = 0
+        self.shown_frames = 0
+
+        self.thread = threading.Thread(
+            target=self.run, name="vestaboard-display", daemon=True
+        )
+        self.thread.start()
+
+    def show(self, message, priority=DisplayPriority.NORMAL):
+        """Queue message for the board and return immediately."""
+        with self.condition:
+            self.submitted_frames += 1
+            if priority in self.pending:
+                self.superseded_frames += 1
+            self.sequence += 1
+            self.pending[priority] = (message, time.perf_counter(), self.sequence)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.is_running and not self.pending:
+                    self.condition.wait()
+                if not self.is_running:
+                    return
+                # the board is still animating the previous frame, newer submissions may land meanwhile
+                while self.is_running:
+                    delay = (
+                        self.last_write_time
+                        + self.min_write_interval
+                        - time.monotonic()
+                    )
+                    if delay <= 0:
+                        break
+                    self.condition.wait(timeout=delay)
+                if not self.is_running:
+                    return
+                priority = max(self.pending)
+                message, queued_at, sequence = self.pending.pop(priority)
+                # a lower-priority frame queued before this one is older news, writing it
+                # afterwards would overwrite the newer frame with a stale one
+                for stale in [
+                    lower
+                    for lower, (_, _, queued_sequence) in self.pending.items()
+                    if queued_sequence < sequence
+                ]:
+                    del self.pending[stale]
+                    self.expired_frames += 1
+
+            stage_timings.record("board_queue", time.perf_counter() - queued_at)
+            self.write(message)
+
+    def write(self, message):
+        try:
+            with stage_timings.span("vbml_convert"):
+                response_code, response = convert_vbml_to_array(message)
+            if not 200 <= response_code < 300:
+                logging.error(f"VBML conversion failed with status {response_code}")
+                return
+            with stage_timings.span("vestaboard_post"):
+                result = self.vestaboard.send_msg(response)
+            if result is None:
+                return  # no reachable board, or the frame failed validation
+            response_code, response = result
+            if response_code == 304:
+                return  # board already showed it, no animation to wait out
+            self.shown_frames += 1
+            self.last_write_time = time.monotonic()
         except Exception as e:
+            logging.error(f"Error writing frame to Vestaboard: {e}")
+
+    def stats(self):
+        with self.condition:
+            return {
+                "submitted_frames": self.submitted_frames,
+                "superseded_frames": self.superseded_frames,
+                "expired_frames": self.expired_frames,
+                "shown_frames": self.shown_frames,
+                "pending_frames": len(self.pending),
+            }
+
+    def close(self):
+        with self.condition:
+            self.is_running = False
+            self.condition.notify_all()
+        self.thread.join()
+
+
+class VbmlCache:
+    """Bounded LRU of converted VBML messages, optionally warmed from and saved to disk."""
+
+    def __init__(
+        self,
+        max_size=vestaboard_metadata["vbml_cache_size"],
+        cache_file=vestaboard_metadata["vbml_cache_file"],
+        save_interval=vestaboard_metadata["vbml_cache_save_interval_seconds"],
+    ):
+        self.max_size = max_size
+        self.cache_file = cache_file
+        self.entries = OrderedDict()  # renderer + message hash -> 6x22 list of lists
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # one writer of the temp file at a time
+        self.hits = 0
+        self.misses = 0
+        self.is_dirty = False  # only rewrite the cache file when new frames were added
+        self.load()
+        self.is_dirty = False
+        self.stopped = threading.Event()
+        if self.cache_file:
+            # leaderboard frames carry ages, so nearly every write is a miss; batching the saves
+            # keeps that from rewriting the file (and the flash under it) on every frame
+            self.saver = threading.Thread(
+                target=self.save_periodically,
+                args=(save_interval,),
+                name="vbml-cache",
+                daemon=True,
+            )
+            self.saver.start()
+            atexit.register(self.close)
+
+    @staticmethod
+    def key(vbml_message, renderer):
+        # the local renderer and the API may lay the same message out differently, never mix them
+        digest = hashlib.sha256(vbml_message.json().encode()).hexdigest()
+        return f"{renderer}:{digest}"
+
+    def get(self, key):
+        with self.lock:
+            converted = self.entries.get(key)
+            if converted is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return [row[:] for row in converted]  # callers may edit their copy
+
+    def put(self, key, converted):
+        with self.lock:
+            self.entries[key] = [row[:] for row in converted]
+            self.is_dirty = True
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def load(self):
+        if not self.cache_file or not os.path.isfile(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, "r") as cache_file:
+                for key, converted in json.load(cache_file).items():
+                    self.put(key, converted)
+            logging.info(
+                f"Warmed VBML cache with {len(self.entries)} frames from {self.cache_file}"
+            )
+        except (json.JSONDecodeError, OSError) as e:
             logging.warning(
-                f"Uncaught error while pinging Vestabord {ip_address}host: {e}"
+                f"Ignoring unreadable VBML cache file {self.cache_file}: {e}"
             )
-            return False
+
+    def save(self):
+        if not self.cache_file or not self.is_dirty:
+            return
+        with self.save_lock:
+            with self.lock:
+                entries = dict(self.entries)
+                self.is_dirty = False
+            try:
+                with open(self.cache_file + ".tmp", "w") as cache_file:
+                    json.dump(entries, cache_file)
+                os.replace(self.cache_file + ".tmp", self.cache_file)
+            except OSError as e:
+                self.is_dirty = True  # try again on the next tick, or at exit
+                logging.warning(f"Unable to save VBML cache to {self.cache_file}: {e}")
+
+    def save_periodically(self, interval):
+        while not self.stopped.wait(interval):
+            self.save()
+
+    def close(self):
+        self.stopped.set()
+        self.save()
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+
+vbml_cache = VbmlCache()
 
 
-def convert_vbml_to_array(vbml_message, url=vestaboard_metadata["vbml_url"]):
+def convert_vbml_to_array(
+    vbml_message,
+    url=vestaboard_metadata["vbml_url"],
+    cache=vbml_cache,
+    renderer=vestaboard_metadata["vbml_renderer"],
+):
+    key = cache.key(vbml_message, renderer)
+    converted = cache.get(key)
+    if converted is not None:
+        logging.info("VBML cache hit, skipping conversion")
+        return 200, converted
+
+    if renderer == "remote":
+        response_code, converted = convert_vbml_to_array_remote(vbml_message, url)
+    else:
+        try:
+            response_code, converted = 200, render_vbml(
+                vbml_message,
+                board_height=vestaboard_metadata["default_height"],
+                board_width=vestaboard_metadata["default_width"],
+            )
+        except Exception as e:
+            logging.error(f"Error rendering VBML message locally: {e}")
+            return 500, ""
+
+    if 200 <= response_code < 300 and converted:
+        cache.put(key, converted)
+    return response_code, converted
+
+
+def convert_vbml_to_array_remote(vbml_message, url=vestaboard_metadata["vbml_url"]):
     headers = {"Content-Type": "application/json"}
     logging.info(
-        f"Calling VBML to Array Endpoint at {url}, with message {vbml_message}"
+        f"Calling VBML to Array Endpoint at {url}, with message {truncate(vbml_message)}"
+    )
+    response = shared_http_client.post(
+        "vbml", url=url, headers=headers, data=vbml_message.json()
     )
-    response = requests.post(url=url, headers=headers, data=vbml_message.json())
     logging.info(
-        f"Received VBML to Array Endpoint response with Status: {response.status_code} and Payload: {response.text}"
+        f"Received VBML to Array Endpoint response with Status: {response.status_code} and Payload: {truncate(response.text)}"
     )
 
     converted_response_text = ""